@@ -0,0 +1,65 @@
+"""Compare JSON backends on a 10k row crudify GET style response.
+
+Usage: `python benchmarks/json_backends.py [rows] [repeat]`
+"""
+import datetime
+import sys
+import timeit
+from decimal import Decimal
+
+from flask import Flask
+
+from powernap.architect.json_backends import JSON_BACKENDS
+from powernap.architect.responses import APIEncoder
+
+
+class Row(object):
+    """Stand in for a model instance returned by `construct_query`."""
+    def __init__(self, i):
+        self.id = i
+        self.name = "device-{}".format(i)
+        self.status = "active" if i % 3 else "suspended"
+        self.price = Decimal("19.99")
+        self.created = datetime.datetime(2019, 1, 23, 12, 30, i % 60)
+        self.tags = ["rack-{}".format(i % 40), "dc-{}".format(i % 4)]
+
+    def api_response(self, exclude_properties=None):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "status": self.status,
+            "price": self.price,
+            "created": self.created,
+            "tags": self.tags,
+        }
+
+
+def main(rows=10000, repeat=5):
+    rows = [Row(i) for i in range(rows)]
+    app = Flask(__name__)
+    with app.app_context():
+        results = {}
+        for name, backend_cls in sorted(JSON_BACKENDS.items()):
+            try:
+                backend = backend_cls()
+            except ImportError as e:
+                print("{:8} skipped: {}".format(name, e))
+                continue
+            for sanitize in (False, True):
+                encoder = APIEncoder(sanitize=sanitize)
+                seconds = min(timeit.repeat(
+                    lambda: backend.dumps(rows, encoder),
+                    number=1, repeat=repeat))
+                results[name, sanitize] = seconds
+                print("{:8} sanitize={!s:5} {:8.2f} ms".format(
+                    name, sanitize, seconds * 1000))
+        for sanitize in (False, True):
+            if ("stdlib", sanitize) in results and \
+                    ("orjson", sanitize) in results:
+                print("orjson speedup (sanitize={}): {:.1f}x".format(
+                    sanitize, results["stdlib", sanitize] /
+                    results["orjson", sanitize]))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
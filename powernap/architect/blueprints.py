@@ -6,14 +6,16 @@ from flask_graphql import GraphQLView
 from flask_login import LoginManager
 
 from powernap.architect.loaders import init_view_modules
+from powernap.architect.requests import to_formdata
 from powernap.auth.rate_limit import check_rate_limit
+from powernap.auth.strategies import get_strategy
 from powernap.auth.token import (
     user_from_redis_token_wrapper,
     request_user_wrapper,
 )
 from powernap.cors import init_cors
 from powernap.decorators import format_
-from powernap.exceptions import ApiError
+from powernap.exceptions import ApiError, InvalidJsonError
 from powernap.helpers import load_from_string
 from powernap.http_codes import (
     empty_success_code,
@@ -35,6 +37,62 @@ def api_error(e):
     return content, e.code
 
 
+# Error of bulk request items that don't exist or aren't owned by the user.
+NOT_FOUND_ERROR = {"errors": ["Not found."]}
+
+# Crudify methods whose options bulk methods use when they have none.
+BULK_FALLBACKS = {
+    "BULK POST": "POST",
+    "BULK PATCH": "PUT",
+    "BULK DELETE": "DELETE",
+}
+
+
+def crudify_key(options, method):
+    """Return the key of `method`'s entry in a crudify option.
+
+    Bulk methods without their own entry use their single item method's.
+    """
+    if method in options:
+        return method
+    return BULK_FALLBACKS.get(method, method)
+
+
+def bulk_items(is_valid, description):
+    """Return the JSON array body of a bulk request.
+
+    Raises :class:`InvalidJsonError` unless `is_valid` is true for every
+    item.
+    """
+    items = request.jsonlist
+    if not all(is_valid(item) for item in items):
+        raise InvalidJsonError(description="Form not API compatible: "
+                               "items must be {}.".format(description))
+    return items
+
+
+def is_id(value):
+    """Return whether a JSON value is an integer id."""
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def is_patch(value):
+    """Return whether a JSON value is an `{id, fields}` object."""
+    return isinstance(value, dict) and is_id(value.get("id")) and \
+        isinstance(value.get("fields", {}), dict)
+
+
+def bulk_errors(forms):
+    """Return the errors of each item of a failed bulk request.
+
+    Valid items have no errors.  Items without a form were not found.
+    """
+    return {"items": [
+        form.format_errors() if form is not None else NOT_FOUND_ERROR
+        for form in forms
+    ]}
+
+
 class Architect:
     """Registers multiple ResponseBlueprints and initializes settings."""
     def __init__(
@@ -44,6 +102,10 @@ class Architect:
         decorators=[
             "powernap.decorators.format_",
             "powernap.decorators.safe",
+            "powernap.decorators.stream",
+            "powernap.decorators.count",
+            "powernap.decorators.coalesce",
+            "powernap.decorators.cache",
             "core.otp.decorators.otp",
             "powernap.decorators.permission",
             "powernap.decorators.login",
@@ -100,7 +162,8 @@ class Architect:
         self.template_dir = template_dir
         self.crudify_funcs = {
             k: crudify_funcs.get(k)
-            for k in ("GET", "GET ONE", "PUT", "POST", "DELETE")
+            for k in ("GET", "GET ONE", "PUT", "POST", "DELETE", "BULK POST",
+                      "BULK PATCH", "BULK DELETE")
         }
         self._init_login_manager(login_manager, user_loader, user_class)
         self.decorators = [load_from_string(path) for path in decorators]
@@ -153,6 +216,8 @@ class Architect:
         """Create a new Blueprint for the Architect to register.
 
         Should only be invoked in the top of files named `views.py`.
+        Accepts a `rate_limit` policy applied to every route of the
+        blueprint, see :meth:`ResponseBlueprint.route`.
         """
         default_options = {k: kwargs.pop(k) for k in self.decorator_names
                            if k in kwargs}
@@ -195,7 +260,7 @@ class ResponseBlueprint(Blueprint):
 
     def __init__(self, name, decorators, import_name='', crudify_funcs=None,
                  default_options=None, permissions=None,
-                 graphql_session_func=None, **kwargs):
+                 graphql_session_func=None, rate_limit=None, **kwargs):
         """
         :param name: (string): Name of blueprint.
         :param decorators: (list): List of functions that will decorate routes.
@@ -208,6 +273,8 @@ class ResponseBlueprint(Blueprint):
             values are human readable strings.
         :param graphql_session_func: (func): Function when executed returns
             a SqlAlchemy session to be used with graphql views.
+        :param rate_limit: (dict): Rate limit policy for every route on this
+            blueprint. See :meth:`route`.
         """
         super(ResponseBlueprint, self).__init__(name, import_name, **kwargs)
         self.decorators = decorators
@@ -215,9 +282,24 @@ class ResponseBlueprint(Blueprint):
         self.default_options = default_options or {}
         self.permissions = permissions
         self.graphql_session_func = graphql_session_func
+        self.rate_limit = self.rate_limit_policy(rate_limit, scope=name)
+        self.rate_limits = {}
 
     def route(self, rule, **options):
-        """Wrap view with api response decorators, make `self.link`."""
+        """Wrap view with api response decorators, make `self.link`.
+
+        Besides the decorator options, accepts a `rate_limit` dict that
+        overrides the blueprint's policy for this route. Keys:
+            strategy: Name of a strategy in
+                :data:`powernap.auth.strategies.RATE_LIMIT_STRATEGIES`.
+            limit: Requests allowed per period for anonymous users.
+            authenticated_limit: Requests allowed for authenticated users.
+                Defaults to `limit`.
+            period: Length of the window in seconds.
+        Missing keys fall back to the blueprint's policy, then to the app
+        settings.  Routes with their own policy, and blueprints with a
+        policy, are counted in their own bucket.
+        """
         link = {'url': self.url_prefix + rule}
         link.update(options)
         self.links.append(link)
@@ -228,9 +310,19 @@ class ResponseBlueprint(Blueprint):
             raise Exception("'{}' is not a valid permission: {}".format(
                 permission, sorted(self.permissions.keys())
             ))
+        rate_limit = options.pop("rate_limit", None)
 
         def decorator(f):
             endpoint = options.pop("endpoint", f.__name__)
+            full_endpoint = "{}.{}".format(self.name, endpoint)
+            policy = self.rate_limit
+            if rate_limit:
+                policy = {k: v for k, v in (self.rate_limit or {}).items()
+                          if k != "scope"}
+                policy.update(rate_limit)
+                policy = self.rate_limit_policy(policy, scope=full_endpoint)
+            if policy:
+                self.rate_limits[full_endpoint] = policy
             for decorator in self.decorators:
                 v = options.pop(decorator.__name__, None)
                 args = [f] if v is None else [f, v]
@@ -246,6 +338,16 @@ class ResponseBlueprint(Blueprint):
             rule, schema=schema, graphiql=True, context={'session': session})
         self.route(rule, methods=['GET', 'POST'], format_=False, **options)(view)
 
+    def rate_limit_policy(self, policy, scope):
+        """Validate a rate limit policy and give it a redis key `scope`."""
+        if not policy:
+            return None
+        policy = dict(policy)
+        if "strategy" in policy:
+            get_strategy(policy["strategy"])
+        policy.setdefault("scope", scope)
+        return policy
+
     def options(self, options):
         """Return a complete list of options for route and decorators."""
         complete = deepcopy(self.default_options)
@@ -258,7 +360,7 @@ class ResponseBlueprint(Blueprint):
         return {"strict_slashes": False}
 
     def crudify(self, url, model, create_form=None, update_form=None, ignore=[],
-                permission={}, **kwargs):
+                permission={}, rate_limit={}, bulk=False, **kwargs):
         """Generates Create, Read, Update, and Delete endpoints.
 
         :param url: The base url string for each endpoint.
@@ -274,6 +376,17 @@ class ResponseBlueprint(Blueprint):
                 "PUT":     "perm",
                 "DELETE":  "perm",
             }
+        :param rate_limit: Dictionary of rate limit policies for each method,
+            keyed like `permission`. Ex:
+            rate_limit = {
+                "GET": {"strategy": "token_bucket", "limit": 60, "period": 60},
+            }
+        :param bulk: Also generate `BULK POST`, `BULK PATCH` and
+            `BULK DELETE` endpoints on `<url>/bulk`.  Each writes all its
+            items in one transaction or none of them, returning a list of
+            errors per item.  Bulk methods without their own `ignore`,
+            `permission` or `rate_limit` entry use the `POST`, `PUT` and
+            `DELETE` entries respectively.
         """
         if not update_form:
             update_form = create_form
@@ -308,6 +421,45 @@ class ResponseBlueprint(Blueprint):
             instance.delete()
             return empty_success_code
 
+        def bulk_post_func():
+            items = bulk_items(lambda item: isinstance(item, dict),
+                               "JSON objects")
+            forms = [create_form(to_formdata(item)) for item in items]
+            if not all([form.validate() for form in forms]):
+                return bulk_errors(forms), error_code
+            instances = model.save_all([form.build_obj() for form in forms])
+            if instances is None:
+                return {"errors": ["Items could not be saved."]}, error_code
+            return instances, post_success_code
+
+        def bulk_patch_func():
+            items = bulk_items(is_patch, "{id, fields} objects")
+            owned = model.get_owned([item["id"] for item in items])
+            forms = [
+                update_form(to_formdata(item.get("fields", {})),
+                            instance=owned[item["id"]])
+                if item["id"] in owned else None
+                for item in items
+            ]
+            if not all([form is not None and form.validate()
+                        for form in forms]):
+                return bulk_errors(forms), error_code
+            instances = model.save_all(
+                [form.build_obj(form.instance) for form in forms])
+            if instances is None:
+                return {"errors": ["Items could not be saved."]}, error_code
+            return instances, success_code
+
+        def bulk_delete_func():
+            ids = bulk_items(is_id, "ids")
+            owned = model.get_owned(ids)
+            if not all(id in owned for id in ids):
+                errors = [{} if id in owned else NOT_FOUND_ERROR for id in ids]
+                return {"items": errors}, error_code
+            if not model.delete_all(list(owned.values())):
+                return {"errors": ["Items could not be deleted."]}, error_code
+            return empty_success_code
+
         funcs = (
             ("GET", self.crudify_funcs.get("GET") or get_func),
             ("GET ONE", self.crudify_funcs.get("GET ONE") or get_one_func),
@@ -315,11 +467,30 @@ class ResponseBlueprint(Blueprint):
             ("PUT", self.crudify_funcs.get("PUT") or put_func),
             ("DELETE", self.crudify_funcs.get("DELETE") or delete_func),
         )
+        if bulk:
+            funcs += (
+                ("BULK POST",
+                 self.crudify_funcs.get("BULK POST") or bulk_post_func),
+                ("BULK PATCH",
+                 self.crudify_funcs.get("BULK PATCH") or bulk_patch_func),
+                ("BULK DELETE",
+                 self.crudify_funcs.get("BULK DELETE") or bulk_delete_func),
+            )
 
         for method, func in funcs:
-            if method not in ignore:
+            if crudify_key(ignore, method) not in ignore:
+                method_kwargs = dict(kwargs)
+                rate_limit_key = crudify_key(rate_limit, method)
+                if rate_limit_key in rate_limit:
+                    method_kwargs["rate_limit"] = rate_limit[rate_limit_key]
+                if method in ("GET", "GET ONE") and \
+                        "coalesce" not in self.default_options and \
+                        "coalesce" in [d.__name__ for d in self.decorators]:
+                    method_kwargs.setdefault("coalesce", True)
                 self.route_crudify_method(
-                    url, model, method, func, permission.get(method), **kwargs)
+                    url, model, method, func,
+                    permission.get(crudify_key(permission, method)),
+                    **method_kwargs)
 
     def route_crudify_method(self, url, model, method, func, permission, **kwargs):
         """Adds the crudify methods as actual routes to the blueprint."""
@@ -327,6 +498,9 @@ class ResponseBlueprint(Blueprint):
         func.__name__ = "{}_{}".format(method, model.__name__)
         if inspect.getargspec(func).args:
             method_url += "/<int:id>"
+        if method.startswith("BULK "):
+            method_url = "{}/bulk".format(url.rstrip("/"))
+            method = method[len("BULK "):]
         methods = [method.split(' ')[0]]
         kwargs["methods"] = methods
         if permission:
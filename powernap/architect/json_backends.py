@@ -0,0 +1,88 @@
+"""JSON backends used to encode responses and decode request bodies.
+
+Backends encode with the hooks of an
+:class:`powernap.architect.responses.APIEncoder` instance (`prepare` and
+`default`) so every backend serializes `Decimal`, `isoformat` values and
+`api_response` objects the same way.  The orjson backend is not a drop-in
+replacement, see :class:`OrjsonJSONBackend`.
+"""
+import json
+from functools import lru_cache
+
+from powernap.helpers import load_from_string
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+class StdlibJSONBackend(object):
+    """Encode with the `json.JSONEncoder` itself."""
+    name = "stdlib"
+
+    def dumps(self, obj, encoder):
+        """Return `obj` encoded by `encoder` as utf-8 bytes."""
+        return encoder.encode(obj).encode('utf-8')
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class OrjsonJSONBackend(object):
+    """Encode with `orjson`, calling the encoder's `default` for other types.
+
+    Output differs from :class:`StdlibJSONBackend` on purpose:
+
+    - it is compact (no space after `,` and `:`) and not ascii escaped.
+    - `NaN` and `Infinity` are encoded as `null`, which is valid JSON,
+      instead of the stdlib's `NaN` and `Infinity`.
+    - `UUID`, `Enum` and subclasses of `str`, `int`, `dict` and `list`
+      are encoded by orjson itself, so encoders registered for them with
+      :func:`powernap.architect.responses.register_type_encoder` are not
+      used.
+
+    Values orjson cannot encode (e.g. integers over 64 bits) fall back to
+    the stdlib encoder.
+    """
+    name = "orjson"
+
+    def __init__(self):
+        if orjson is None:
+            raise ImportError("The orjson JSON backend requires orjson.")
+        # Let the encoder format dates and dataclasses like the stdlib.
+        self.option = orjson.OPT_NON_STR_KEYS | \
+            orjson.OPT_PASSTHROUGH_DATETIME | \
+            orjson.OPT_PASSTHROUGH_DATACLASS
+
+    def dumps(self, obj, encoder):
+        """Return `obj` encoded with `encoder.default` as utf-8 bytes."""
+        try:
+            return orjson.dumps(encoder.prepare(obj), default=encoder.default,
+                                option=self.option)
+        except orjson.JSONEncodeError as e:
+            if isinstance(e.__cause__, TypeError):
+                raise e.__cause__
+            return encoder.encode(obj).encode('utf-8')
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+JSON_BACKENDS = {
+    StdlibJSONBackend.name: StdlibJSONBackend,
+    OrjsonJSONBackend.name: OrjsonJSONBackend,
+}
+
+
+@lru_cache(maxsize=None)
+def get_json_backend(name="auto"):
+    """Return a JSON backend instance.
+
+    :param name: (string): `stdlib`, `orjson`, an import path to a backend
+        class, or `auto` to use orjson when it is installed.
+    """
+    if name == "auto":
+        name = OrjsonJSONBackend.name if orjson else StdlibJSONBackend.name
+    cls = JSON_BACKENDS.get(name) or load_from_string(name)
+    return cls()
@@ -1,7 +1,6 @@
 # pylint: disable=too-many-ancestors
 """Extend Flask's Request class with fixes and helpers"""
 
-import ipaddress
 from contextlib import suppress
 
 from flask import Request, current_app
@@ -9,7 +8,9 @@ from werkzeug.datastructures import MultiDict
 from werkzeug.exceptions import BadRequest
 from werkzeug.utils import cached_property
 
+from powernap.architect.json_backends import get_json_backend
 from powernap.exceptions import InvalidJsonError
+from powernap.networks import compile_networks
 
 
 class ApiRequest(Request):
@@ -19,23 +20,41 @@ class ApiRequest(Request):
     def jsonform(self):
         """Parses and returns form for JSON body"""
         formdata = {}
-        with suppress(BadRequest):
-            formdata = self.get_json(force=True) or {}
+        with suppress(BadRequest, ValueError):
+            formdata = self.json_backend.loads(self.get_data(cache=True)) or {}
             if not isinstance(formdata, dict):
                 raise InvalidJsonError(description="Form not API compatible: must be JSON object.")
             if formdata and self.mimetype != 'application/json':
                 current_app.logger.warning(
                     'JSON data with incorrect mimetype! {} {} {} {}'.format(
-                        self.remote_addr, self.method, self.scheme, self.full_path,
+                        self.client_addr, self.method, self.scheme, self.full_path,
                     ))
-        # The MultiDict *must* be created this way. It treats a passed dict as a
-        # MultiDict which is not what you want.
-        # A normal dict converted (correctly) to a MultiDict looks like the following
-        # inside of the MultiDict: {k:[v] for k, v in dict.items()}
-        return MultiDict(list(formdata.items()))
+        return to_formdata(formdata)
+
+    @cached_property
+    def jsonlist(self):
+        """Parses and returns the JSON array body of bulk requests.
+
+        Setting: `BULK_MAX_ITEMS`, max items per request.  Defaults to
+        `1000`.
+        """
+        items = None
+        with suppress(BadRequest, ValueError):
+            items = self.json_backend.loads(self.get_data(cache=True))
+        if not isinstance(items, list):
+            raise InvalidJsonError(description="Form not API compatible: must be JSON array.")
+        limit = current_app.config.get('BULK_MAX_ITEMS', 1000)
+        if len(items) > limit:
+            raise InvalidJsonError(description="Too many items: max {}.".format(limit))
+        return items
 
     @property
-    def remote_addr(self):
+    def json_backend(self):
+        """The :mod:`powernap.architect.json_backends` backend in use."""
+        return get_json_backend(current_app.config.get('JSON_BACKEND', 'auto'))
+
+    @cached_property
+    def client_addr(self):
         """Safely get the originating ip of the request.
 
         See: https://stackoverflow.com/a/22936947/3453043
@@ -43,25 +62,32 @@ class ApiRequest(Request):
         Walks a list of originating IP addresses backwards until
         one is found from outside of all trusted proxy networks.
         Return the most recent address, remote_addr, if all are
-        trusted.
+        trusted.  Resolved once per request.
+
+        Werkzeug sets `remote_addr` on the instance, so it can't be
+        overridden and holds the address of the peer.
         """
-        remote_addr = super(ApiRequest, self).remote_addr
+        remote_addr = self.remote_addr
 
         if not remote_addr:
             return '127.0.0.1'
 
-        route = reversed(self.access_route + [remote_addr])
-        route = map(ipaddress.ip_address, route)
-        trusted_proxies = map(ipaddress.ip_network, self.trusted_proxies)
-
-        def untrusted(addr):
-            "Return True if addr is NOT included inside any trusted networks"
-            return not any(addr in net for net in trusted_proxies)
-
-        untrusted_routes = filter(untrusted, route)
-        return str(next(untrusted_routes, remote_addr))
+        trusted_proxies = compile_networks('TRUSTED_PROXIES')
+        for addr in reversed(self.access_route + [remote_addr]):
+            if addr not in trusted_proxies:
+                return addr
+        return remote_addr
 
     @property
     def trusted_proxies(self):
         """Return list of trusted proxy networks, e.g. ['192.168.1.0/24']"""
         return current_app.config.get('TRUSTED_PROXIES', [])
+
+
+def to_formdata(data):
+    """Return a JSON object as a MultiDict that forms accept."""
+    # The MultiDict *must* be created this way. It treats a passed dict as a
+    # MultiDict which is not what you want.
+    # A normal dict converted (correctly) to a MultiDict looks like the following
+    # inside of the MultiDict: {k:[v] for k, v in dict.items()}
+    return MultiDict(list(data.items()))
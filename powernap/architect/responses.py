@@ -1,27 +1,122 @@
+import hashlib
 import logging
 import json
 import re
 from decimal import Decimal
+from enum import Enum
+from inspect import signature
+from operator import attrgetter
+from types import GeneratorType
+from uuid import UUID
 
 from sqlalchemy import inspect
-from flask import current_app, jsonify, Response, request, session
+from sqlalchemy.orm import Query
+from flask import (
+    current_app,
+    g,
+    jsonify,
+    Response,
+    request,
+    session,
+    stream_with_context,
+)
 from flask_login import current_user
 from flask_sqlalchemy import Pagination
 
+from powernap.architect.json_backends import get_json_backend
+from powernap.mixins import PowernapMixin
+from powernap.query.keyset import KeysetPagination
+from powernap.sanitize import clean, sanitize
+
+
+TYPE_ENCODERS = {
+    Decimal: float,
+    UUID: str,
+    Enum: attrgetter('value'),
+}
+
+# Cache of the encode function resolved for each class by `APIEncoder`.
+_type_dispatch = {}
+
+
+def register_type_encoder(type_, func):
+    """Encode instances of `type_` (and subclasses) as `func(instance)`.
+
+    e.g. `register_type_encoder(bytes, lambda b: b64encode(b).decode())`
+    """
+    TYPE_ENCODERS[type_] = func
+    _type_dispatch.clear()
+
+
+def accepts_exclude_properties(func):
+    """Return True if `func` can be called with `exclude_properties`."""
+    try:
+        params = signature(func).parameters.values()
+    except (TypeError, ValueError):
+        return False
+    return any(p.name == 'exclude_properties' or p.kind == p.VAR_KEYWORD
+               for p in params)
+
 
 class APIEncoder(json.JSONEncoder):
-    """Allows json.dumps to accept classses with api_respones method."""
-    def __init__(self, exclude_properties=None, *args, **kwargs):
+    """Allows json.dumps to accept classses with api_respones method.
+
+    With `sanitize` every string is bleached once as it is encoded.
+
+    How instances of a class are encoded is resolved once per class, in
+    this order: :data:`TYPE_ENCODERS`, an `isoformat` method, then an
+    `api_response` method.
+    """
+    def __init__(self, exclude_properties=None, *args, sanitize=False,
+                 **kwargs):
         self.exclude_properties = exclude_properties or []
+        self.sanitize = sanitize
         return super(APIEncoder, self).__init__(*args, **kwargs)
 
+    def encode(self, o):
+        if self.sanitize and isinstance(o, str):
+            o = clean(o)
+        return super(APIEncoder, self).encode(o)
+
+    def iterencode(self, o, _one_shot=False):
+        return super(APIEncoder, self).iterencode(self.prepare(o), _one_shot)
+
+    def prepare(self, o):
+        """Return `o` ready to encode. Bleaches its strings if `sanitize`."""
+        return sanitize(o) if self.sanitize else o
+
     def default(self, o):
-        if isinstance(o, Decimal):
-            return float(o)
-        elif hasattr(o, 'isoformat'):
-            return o.isoformat()
-        elif hasattr(o, 'api_response'):
-            return self.get_api_response(o)
+        cls = o.__class__
+        func = _type_dispatch.get(cls)
+        if func is None:
+            func = self.resolve_encoder(cls)
+            if func is not None:
+                _type_dispatch[cls] = func
+            elif hasattr(o, 'isoformat'):
+                return o.isoformat()
+            elif hasattr(o, 'api_response'):
+                return self.prepare(self.get_api_response(o))
+            else:
+                return self.not_serializable(o)
+        return func(self, o)
+
+    @staticmethod
+    def resolve_encoder(cls):
+        """Return a `func(encoder, o)` for instances of `cls` or None."""
+        for base in cls.__mro__:
+            if base in TYPE_ENCODERS:
+                type_encoder = TYPE_ENCODERS[base]
+                return lambda encoder, o: encoder.prepare(type_encoder(o))
+        if hasattr(cls, 'isoformat'):
+            return lambda encoder, o: o.isoformat()
+        if hasattr(cls, 'api_response'):
+            if accepts_exclude_properties(cls.api_response):
+                return lambda encoder, o: encoder.prepare(o.api_response(
+                    exclude_properties=encoder.exclude_properties))
+            return lambda encoder, o: encoder.prepare(o.api_response())
+        return None
+
+    def not_serializable(self, o):
         try:
             return super(APIEncoder, self).default(o)
         except TypeError:
@@ -30,31 +125,75 @@ class APIEncoder(json.JSONEncoder):
             raise TypeError(msg)
 
     def get_api_response(self, item):
-        try:
-            item = item.api_response(**{'exclude_properties': self.exclude_properties})
-        except TypeError:
-            item = item.api_response()
-        return item
+        if accepts_exclude_properties(item.api_response):
+            return item.api_response(exclude_properties=self.exclude_properties)
+        return item.api_response()
 
 
 class ApiResponse(object):
     """Create the base api_response."""
-    def __init__(self, data, status_code, headers=None, json_encoder=APIEncoder):
+    # Bytes of encoded items buffered before a streamed chunk is sent.
+    stream_chunk_size = 64 * 1024
+
+    def __init__(self, data, status_code, headers=None, json_encoder=APIEncoder,
+                 stream=None):
+        """
+        :param stream: (bool): Encode lists, queries and paginated items one
+            at a time into a streamed response. Defaults to the `stream`
+            decorator's option for the current route.
+        """
         self.data = data
         self.headers = headers or {}
         self.status_code = status_code
         self.headers = headers or {}
         self.json_encoder = self.prepped_encoder(json_encoder)
+        if stream is None:
+            stream = g.get('stream_response', False)
+        self.stream = stream
+        self.json_backend = get_json_backend(
+            current_app.config.get('JSON_BACKEND', 'auto'))
+        if g.get('cache_response'):
+            g.response_models = self.models()
         if isinstance(data, Pagination):
             self.headers.update({'X-Pagination': self.pagination_headers(data)})
             self.data = data.items
+        elif isinstance(data, KeysetPagination):
+            self.headers.update({
+                'X-Pagination': self.keyset_pagination_headers(data),
+                'X-Pagination-Cursor': self.cursor_headers(data),
+            })
+            self.data = data.items
+
+    def models(self):
+        """Return the classes of the model instances in `self.data`.
+
+        Queries and pages give the models they select, even when empty.
+        """
+        data = self.data
+        if isinstance(data, (Pagination, KeysetPagination)):
+            data = data.query if data.query is not None else data.items
+        if isinstance(data, Query):
+            return {d['entity'] for d in data.column_descriptions
+                    if isinstance(d['entity'], type) and
+                    issubclass(d['entity'], PowernapMixin)}
+        if not isinstance(data, (list, tuple)):
+            data = [data]
+        return {item.__class__ for item in data
+                if isinstance(item, PowernapMixin)}
 
     def prepped_encoder(self, json_encoder):
-        """Allows for a APIEncoder initialized with the excluded props."""
+        """Allows for a APIEncoder initialized with the excluded props.
+
+        The encoder bleaches strings when the `safe` decorator asked for
+        sanitization of this request's response.
+        """
         exclude_properties = getattr(session, 'exclude_properties', [])
         if exclude_properties:
             del session.exclude_properties
-        return lambda *args, **kwargs: json_encoder(exclude_properties, *args, **kwargs)
+        self.exclude_properties = exclude_properties
+        sanitize = g.get('sanitize_response', False)
+        return lambda *args, **kwargs: json_encoder(
+            exclude_properties, *args, sanitize=sanitize, **kwargs)
 
     def pagination_headers(self, data):
         return {
@@ -67,19 +206,120 @@ class ApiResponse(object):
             'total': data.total,
         }
 
+    def keyset_pagination_headers(self, data):
+        return {
+            'per_page': data.per_page,
+            'total': data.total,
+        }
+
+    def cursor_headers(self, data):
+        return {
+            'next': data.next_cursor,
+            'previous': data.prev_cursor,
+        }
+
+    @property
+    def streamable(self):
+        return self.stream and \
+            isinstance(self.data, (list, tuple, Query, GeneratorType))
+
+    @property
+    def conditional(self):
+        """True if the response can be a `304 Not Modified`.
+
+        Setting: `CONDITIONAL_GET`, defaults to `True`.
+        """
+        return self.status_code == 200 and \
+            request.method in ('GET', 'HEAD') and \
+            current_app.config.get('CONDITIONAL_GET', True)
+
+    def row_validators(self):
+        """Return `(etag, last_modified)` of a single row, or None.
+
+        Available for :class:`powernap.mixins.PowernapMixin` instances with
+        a version or last modified column, so a `304` can be returned
+        without serializing the row.  The ETag covers the row's identity
+        and version, the excluded properties, sanitization and the
+        `ETAG_SALT` setting (change it when `api_response` changes).
+        """
+        if not isinstance(self.data, PowernapMixin):
+            return None
+        version = self.data.row_version
+        last_modified = self.data.row_last_modified
+        if version is None and last_modified is None:
+            return None
+        key = repr((
+            self.data.__class__.__name__, inspect(self.data).identity,
+            version if version is not None else last_modified,
+            sorted(self.exclude_properties),
+            bool(g.get('sanitize_response')),
+            current_app.config.get('ETAG_SALT', ''),
+        ))
+        return hashlib.sha1(key.encode('utf-8')).hexdigest(), last_modified
+
     @property
     def response(self):
-        data = json.dumps(self.data, cls=self.json_encoder)
-        resp = Response(data, mimetype='application/json')
+        if self.streamable:
+            return self.streamed_response
+        resp = Response(mimetype='application/json', status=self.status_code)
         resp.headers.extend(self.headers)
-        
+        validators = self.row_validators() if self.conditional else None
+        if validators:
+            etag, last_modified = validators
+            resp.set_etag(etag, weak=True)
+            if last_modified is not None:
+                resp.last_modified = last_modified
+            resp.make_conditional(request)
+            if resp.status_code == 304:
+                if g.get('sanitize_response'):
+                    g.response_sanitized = True
+                return resp, resp.status_code
+        data = self.json_backend.dumps(self.data, self.json_encoder())
+        resp.set_data(data)
+        if g.get('sanitize_response'):
+            g.response_sanitized = True
+        if self.conditional and not validators:
+            resp.add_etag()
+            resp.make_conditional(request)
+
         self.log_error_if_bad_admin_request(data)
+        return resp, resp.status_code
+
+    @property
+    def streamed_response(self):
+        """Response that encodes `self.data` item by item as it is sent.
+
+        Only one item and its encoded form are held in memory at a time
+        (plus the items of a page that were already loaded).
+        """
+        encoder = self.json_encoder()
+        chunks = stream_with_context(self.iter_encode(self.data, encoder))
+        resp = Response(chunks, mimetype='application/json')
+        resp.headers.extend(self.headers)
+        if g.get('sanitize_response'):
+            g.response_sanitized = True
         return resp, self.status_code
 
+    def iter_encode(self, items, encoder):
+        """Yield a JSON array of `items` in `stream_chunk_size` chunks."""
+        buffer = [b'[']
+        size = 0
+        for i, item in enumerate(items):
+            encoded = self.json_backend.dumps(item, encoder)
+            buffer.append(b', ' + encoded if i else encoded)
+            size += len(encoded)
+            if size >= self.stream_chunk_size:
+                yield b''.join(buffer)
+                buffer = []
+                size = 0
+        buffer.append(b']')
+        yield b''.join(buffer)
+
     def log_error_if_bad_admin_request(self, data):
         if not current_app.config['DEBUG'] and \
                 getattr(current_user, 'is_admin', False) and \
                 self.status_code // 100 == 4:
-            msg = "Bad Admin Request to '{}': {}".format(request.path, data)
+            msg = "Bad Admin Request to '{}': {}".format(
+                request.path, data.decode('utf-8'))
             logging.warning(msg)
 
@@ -1,6 +1,36 @@
-from sqlalchemy import Column, Integer, String
+import os
 
-from powernap.helpers import model_attrs
+from flask import current_app
+from sqlalchemy import Column, Index, Integer, String
+from sqlalchemy.ext.declarative import declared_attr
+
+from powernap.helpers import LRUCache, model_attrs, redis_connection
+
+
+class PermissionTrie(object):
+    """Prefix tree of a user's `.` separated permissions.
+
+    A permission is contained if it is a whole-segment prefix of a held
+    permission, so holding "device.edit" grants "device" but not
+    "device.delete" or "dev".  Lookups are O(depth).
+    """
+    def __init__(self, permissions=()):
+        self.root = {}
+        for permission in permissions:
+            self.add(permission)
+
+    def add(self, permission):
+        node = self.root
+        for part in permission.split('.'):
+            node = node.setdefault(part, {})
+
+    def __contains__(self, permission):
+        node = self.root
+        for part in permission.split('.'):
+            node = node.get(part)
+            if node is None:
+                return False
+        return True
 
 
 class PermissionUserMixin(object):
@@ -10,19 +40,16 @@ class PermissionUserMixin(object):
     inherits from `PermissionsTableMixin`.
     """
     def has_permission(self, permission):
-        client_key, _ = model_attrs()
-        query = "{}%".format(permission)
-        return bool(self.permission_class.query.filter(
-            self.permission_class.permission.like(query),
-            self.permission_class.user_id == getattr(self, client_key),
-        ).first())
+        return permission in self.permission_trie
 
     def add_permission(self, permission):
         client_key, _ = model_attrs()
-        permission, _ = self.permission_class.get_or_create(
+        permission, created = self.permission_class.get_or_create(
             user_id=getattr(self, client_key),
             permission=permission,
         )
+        if created:
+            self.invalidate_permissions()
         return permission
 
     @property
@@ -31,6 +58,50 @@ class PermissionUserMixin(object):
         return self.permission_class.query.filter_by(
             user_id=getattr(self, client_key)).all()
 
+    @property
+    def permission_trie(self):
+        """The user's :class:`PermissionTrie`, loaded once per instance."""
+        trie = self.__dict__.get('_permission_trie')
+        if trie is None:
+            trie = self._permission_trie = self.load_permission_trie()
+        return trie
+
+    def load_permission_trie(self):
+        """Return the user's permissions from the cache or the database.
+
+        With `PERMISSION_CACHE` enabled tries are cached per worker and
+        checked against a version number in redis that
+        :meth:`invalidate_permissions` increments.
+        """
+        cache = permission_cache()
+        if cache is None:
+            return PermissionTrie(self.permission_names())
+        client_key, _ = model_attrs()
+        user_id = getattr(self, client_key)
+        version = redis_connection().get(permission_version_key(user_id))
+        entry = cache.get(user_id)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+        trie = PermissionTrie(self.permission_names())
+        cache.set(user_id, (version, trie))
+        return trie
+
+    def permission_names(self):
+        client_key, _ = model_attrs()
+        column = self.permission_class.permission
+        rows = self.permission_class.query.with_entities(column).filter(
+            self.permission_class.user_id == getattr(self, client_key))
+        return [row[0] for row in rows]
+
+    def invalidate_permissions(self):
+        """Drop cached permissions after the user's permissions change."""
+        self.__dict__.pop('_permission_trie', None)
+        if permission_cache() is not None:
+            client_key, _ = model_attrs()
+            user_id = getattr(self, client_key)
+            redis_connection().incr(permission_version_key(user_id))
+            permission_cache().pop(user_id)
+
 
 class PermissionTableMixin(object):
     __tablename__ = "powernap_permissions"
@@ -39,9 +110,39 @@ class PermissionTableMixin(object):
     user_id = Column(Integer(), nullable=False, index=True)
     permission = Column(String(255), nullable=False)
 
+    @declared_attr
+    def __table_args__(cls):
+        return (Index('ix_{}_user_id_permission'.format(cls.__tablename__),
+                      'user_id', 'permission'),)
+
     def api_response(self):
         return {
             "id": self.id,
             "user_id": self.user_id,
             "permission": self.permission,
         }
+
+
+_permissions = None
+_permissions_pid = None
+
+
+def permission_cache():
+    """Return the process's permission cache or None if disabled.
+
+    Settings:
+        `PERMISSION_CACHE`: Enables the cache. Defaults to `False`.
+        `PERMISSION_CACHE_SIZE`: Max users cached per worker.
+    """
+    global _permissions, _permissions_pid
+    if not current_app.config.get("PERMISSION_CACHE", False):
+        return None
+    if _permissions is None or _permissions_pid != os.getpid():
+        _permissions = LRUCache(
+            current_app.config.get("PERMISSION_CACHE_SIZE", 10000))
+        _permissions_pid = os.getpid()
+    return _permissions
+
+
+def permission_version_key(user_id):
+    return "powernap:permissions:{}".format(user_id)
@@ -1,10 +1,14 @@
-import ipaddress
+import os
+import threading
+import time
 
-from flask import current_app, request
+from flask import current_app, g, request
 from flask_login import current_user
 
+from powernap.auth.strategies import get_strategy
 from powernap.exceptions import RequestLimitError
-from powernap.helpers import redis_connection
+from powernap.helpers import LRUCache, redis_connection
+from powernap.networks import compile_networks
 
 
 def check_rate_limit():
@@ -14,17 +18,169 @@ def check_rate_limit():
         raise RequestLimitError(description=msg)
 
 
+def client_addr():
+    """Return the client's ip, past trusted proxies with an `ApiRequest`."""
+    return getattr(request, 'client_addr', request.remote_addr)
+
+
+def route_rate_limit():
+    """Return the rate limit policy registered for the current endpoint.
+
+    Policies are set with the `rate_limit` option of
+    :meth:`powernap.architect.blueprints.ResponseBlueprint.route`.
+    """
+    blueprint = current_app.blueprints.get(request.blueprint)
+    return getattr(blueprint, 'rate_limits', {}).get(request.endpoint)
+
+
+class _LocalCount(object):
+    """Hits for one key: last count seen in redis plus unsynced hits."""
+    __slots__ = ('strategy', 'limit', 'period', 'known', 'delta',
+                 'inflight', 'reset_at')
+
+    def __init__(self, strategy, limit, period):
+        self.strategy = strategy
+        self.limit = limit
+        self.period = period
+        self.known = None
+        self.delta = 0
+        self.inflight = 0
+        self.reset_at = 0
+
+    def count(self, now):
+        if now >= self.reset_at:
+            self.known = 0
+        return (self.known or 0) + self.inflight + self.delta
+
+
+class LocalRateLimitCounter(object):
+    """Count hits in process and push them to redis in batches.
+
+    Each key's count is the last total redis returned plus the hits this
+    worker has not synced yet, so requests over the limit are rejected
+    without a round trip.  Deltas are flushed in one pipeline once
+    `sync_hits` hits are pending or `sync_interval` seconds have passed.
+    Hits from other workers are only seen on the next sync and hits of
+    keys evicted from the LRU before a sync are flushed with the next batch.
+    """
+    def __init__(self, maxsize=10000, sync_interval=1.0, sync_hits=100):
+        self.sync_interval = sync_interval
+        self.sync_hits = sync_hits
+        self.counts = LRUCache(maxsize, on_evict=self._evicted)
+        self.pending = 0
+        self.last_sync = time.monotonic()
+        self._evicted_counts = []
+        self._lock = threading.Lock()
+
+    def hit(self, strategy, key, limit, period):
+        """Count a hit for `key` and return the local `(count, reset)`."""
+        now = time.monotonic()
+        with self._lock:
+            local = self.counts.get(key)
+            if local is None or local.strategy.name != strategy.name:
+                # New keys count from zero until the next sync.
+                local = _LocalCount(strategy, limit, period)
+                local.reset_at = now + period
+                self.counts.set(key, local)
+            local.delta += 1
+            self.pending += 1
+            due = self.pending >= self.sync_hits or \
+                now - self.last_sync >= self.sync_interval
+        if due:
+            self.flush()
+        with self._lock:
+            now = time.monotonic()
+            return local.count(now), max(0, int(local.reset_at - now))
+
+    def flush(self):
+        """Send all pending deltas to redis in one pipeline per connection.
+
+        Deltas of a pipeline that fails are kept for the next sync.
+        """
+        with self._lock:
+            batch = [(key, local, local.delta)
+                     for key, local in self.counts.items() + self._evicted_counts
+                     if local.delta]
+            for _, local, delta in batch:
+                local.delta = 0
+                local.inflight += delta
+            self._evicted_counts = []
+            self.pending = 0
+            self.last_sync = time.monotonic()
+
+        pipes = {}
+        for key, local, delta in batch:
+            redis = local.strategy.redis
+            pipe = pipes.get(id(redis))
+            if pipe is None:
+                pipe = pipes[id(redis)] = [redis.pipeline(transaction=False), []]
+            local.strategy.call(key, local.limit, local.period, delta,
+                                client=pipe[0])
+            pipe[1].append((local, delta))
+
+        for pipe, queued in pipes.values():
+            try:
+                results = pipe.execute()
+            except Exception as e:
+                current_app.logger.warning(
+                    'Rate limit sync failed: {}'.format(str(e)))
+                with self._lock:
+                    for local, delta in queued:
+                        local.inflight -= delta
+                        local.delta += delta
+                        self.pending += delta
+                continue
+            now = time.monotonic()
+            with self._lock:
+                for (local, delta), raw in zip(queued, results):
+                    count, reset = local.strategy.parse(raw)
+                    local.known = count
+                    local.inflight -= delta
+                    local.reset_at = now + reset
+
+    def _evicted(self, key, local):
+        if local.delta:
+            self._evicted_counts.append((key, local))
+
+
+_local_counter = None
+_local_counter_pid = None
+
+
+def local_rate_limit_counter():
+    """Return this process's :class:`LocalRateLimitCounter`."""
+    global _local_counter, _local_counter_pid
+    if _local_counter is None or _local_counter_pid != os.getpid():
+        config = current_app.config
+        _local_counter = LocalRateLimitCounter(
+            maxsize=config.get('RATE_LIMIT_LOCAL_MAX_KEYS', 10000),
+            sync_interval=config.get('RATE_LIMIT_LOCAL_SYNC_MS', 1000) / 1000,
+            sync_hits=config.get('RATE_LIMIT_LOCAL_SYNC_HITS', 100),
+        )
+        _local_counter_pid = os.getpid()
+    return _local_counter
+
+
 class RateLimiter:
     """Handles rate limit functionality: count, session, & headers."""
-    def __init__(self, user, db=0):
+    def __init__(self, user, db=0, policy=None):
         """
         :param user: A user who inherits from
             :class`core.shepherd.mixins.PermissionsMixin`
         :param db: The redis db num to connect to.
+        :param policy: (dict): Overrides the app's rate limit settings.
+            Keys are `strategy`, `limit`, `authenticated_limit`, `period`,
+            `local` and `scope`.  Defaults to the current endpoint's policy.
         """
-        self.ip = request.remote_addr
+        self.ip = client_addr()
         self.redis = redis_connection(db)
         self.user = user
+        self.policy = (route_rate_limit() or {}) if policy is None else policy
+        strategy = self.policy.get(
+            'strategy', current_app.config.get('RATE_LIMIT_STRATEGY'))
+        self.strategy = get_strategy(strategy or 'fixed_window')(self.redis)
+        self.local = self.policy.get(
+            'local', current_app.config.get('RATE_LIMIT_LOCAL', False))
 
     def headers(self):
         """Return ratelimit headers for `self.user`.
@@ -33,54 +189,78 @@ class RateLimiter:
             X-RateLimit-Limit: The maximum amount of requests.
             X-RateLimit-Remaining: The number of requests Remaining.
             X-RateLimit-Reset: Seconds until reset of ratelimit.
+
+        Uses the count recorded by :meth:`over_limit` earlier in the
+        request when available so no additional redis calls are made.
         """
         token, limit = self.token, self.limit
-        remaining = limit - int(self.redis.get(token) or 0)
+        count, reset = self.current(token)
+        remaining = limit - count
         if remaining < 0:
             remaining = 0
         return {
             'X-RateLimit-Limit': limit,
             'X-RateLimit-Remaining': remaining,
-            'X-RateLimit-Reset': self.redis.ttl(token),
+            'X-RateLimit-Reset': reset,
         }
 
+    def current(self, key):
+        """Return `(count, reset)` for `key` without counting a request."""
+        result = g.get('rate_limit_result')
+        if result and result[0] == key:
+            return result[1:]
+        return self.strategy.hit(key, self.limit, self.period, cost=0)
+
     def is_rate_limited(self):
         return not self.ip_is_whitelisted() and \
                 self.over_limit(self.token, self.limit)
 
     def over_limit(self, key, limit):
-        if self.redis.exists(key):
-            requests = self.redis.incr(key)
-        else:
-            requests = self.redis.setex(
-                key, 1, current_app.config['RATE_LIMIT_EXPIRATION']
-            )
-
+        count, _ = self.hit(key, limit)
         if not current_app.config.get("RATE_LIMITING", True):
             return False
-        return requests > limit
+        return count > limit
+
+    def hit(self, key, limit):
+        """Count a request against `key` atomically and return the
+        `(count, reset)` reported by `self.strategy`.
+
+        The result is stored on :data:`flask.g` for :meth:`headers`.
+        In `local` mode the hit is counted by
+        :class:`LocalRateLimitCounter` and only synced to redis in batches.
+        """
+        if self.local:
+            count, reset = local_rate_limit_counter().hit(
+                self.strategy, key, limit, self.period)
+        else:
+            count, reset = self.strategy.hit(key, limit, self.period)
+        g.rate_limit_result = (key, count, reset)
+        return count, reset
 
     def ip_is_whitelisted(self):
-        whitelist = current_app.config.get('RATE_LIMIT_WHITELIST', [])
-        whitelist = [ipaddress.ip_network(ip) for ip in whitelist]
-        request_ip = ipaddress.IPv4Address(self.ip)
-        for network in whitelist:
-            if request_ip in network:
-                return True
-        return False
+        return self.ip in compile_networks('RATE_LIMIT_WHITELIST')
 
     @property
     def token(self):
-        if self.user.is_authenticated:
-            return self.redis_token()
-        return self.ip
+        token = self.redis_token() if self.user.is_authenticated else self.ip
+        if self.strategy.name != 'fixed_window':
+            token = "{}:{}".format(token, self.strategy.name)
+        if self.policy.get('scope'):
+            token = "{}:{}".format(token, self.policy['scope'])
+        return token
 
     @property
     def limit(self):
-        val = 'REQUESTS_PER_HOUR'
         if self.user.is_authenticated:
-            val = 'AUTHENTICATED_REQUESTS_PER_HOUR'
-        return current_app.config[val]
+            limit = self.policy.get('authenticated_limit',
+                                    self.policy.get('limit'))
+            return limit or current_app.config['AUTHENTICATED_REQUESTS_PER_HOUR']
+        return self.policy.get('limit') or current_app.config['REQUESTS_PER_HOUR']
+
+    @property
+    def period(self):
+        return self.policy.get('period') or \
+            current_app.config['RATE_LIMIT_EXPIRATION']
 
     def redis_token(self):
         # TODO: DVTM-1054 fix admin token rate limiting properly
@@ -91,5 +271,5 @@ class RateLimiter:
         return "{}:{}:{}".format(
             str(self.user.__class__),
             user_id,
-            request.remote_addr,
+            self.ip,
         )
@@ -0,0 +1,186 @@
+"""Rate limiting algorithms used by :class:`.rate_limit.RateLimiter`.
+
+Every strategy is a lua script that updates its redis structure and
+returns `{count, reset}` in a single round trip.  `count` is the number of
+requests used in the current window (including this one) and is greater
+than the limit when the request is rejected.  `reset` is the number of
+seconds until the client has its full limit again.
+"""
+
+RATE_LIMIT_STRATEGIES = {}
+
+# Registered script of each strategy class, shared by its instances.
+_scripts = {}
+
+# Scripts that read the server clock must replicate their effects rather
+# than the script itself.  Redis >= 7 always does and ignores the call.
+_REPLICATE_COMMANDS = """
+if redis.replicate_commands then
+    redis.replicate_commands()
+end
+"""
+
+
+class _StrategyMeta(type):
+    """On import makes `RATE_LIMIT_STRATEGIES`.
+
+    Key is the strategy's `name` and value is the
+    :class:`.BaseRateLimitStrategy` subclass."""
+    def __init__(cls, name, bases, dct):
+        if dct.get('name'):
+            RATE_LIMIT_STRATEGIES[dct['name']] = cls
+        super(_StrategyMeta, cls).__init__(name, bases, dct)
+
+
+class BaseRateLimitStrategy(object, metaclass=_StrategyMeta):
+    """Count requests for a key with a redis lua script.
+
+    :attr name: Name used to select the strategy in settings and route
+        options.
+    :attr script: Lua script called with `KEYS[1]` as the rate limit key
+        and `ARGV` as `limit`, `period` (seconds) and `cost`.
+    """
+    name = None
+    script = None
+
+    def __init__(self, redis):
+        self.redis = redis
+        self._script = _scripts.get(type(self))
+        if self._script is None:
+            self._script = _scripts[type(self)] = \
+                redis.register_script(self.script)
+
+    def hit(self, key, limit, period, cost=1):
+        """Count `cost` requests against `key` and return `(count, reset)`."""
+        return self.parse(self.call(key, limit, period, cost))
+
+    def call(self, key, limit, period, cost=1, client=None):
+        """Run the script. Pass a pipeline as `client` to batch calls."""
+        return self._script(keys=[key], args=self.args(limit, period, cost),
+                            client=client or self.redis)
+
+    def args(self, limit, period, cost):
+        return [limit, period, cost]
+
+    def parse(self, raw):
+        count, reset = raw
+        return int(count), int(reset)
+
+
+class FixedWindowStrategy(BaseRateLimitStrategy):
+    """Counter that resets `period` seconds after the first request.
+
+    Uses a single integer key.  Rejected requests are still counted.
+    """
+    name = "fixed_window"
+    script = """
+local count = redis.call('INCRBY', KEYS[1], ARGV[3])
+local ttl = redis.call('TTL', KEYS[1])
+if ttl < 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    ttl = tonumber(ARGV[2])
+end
+return {count, ttl}
+"""
+
+
+class SlidingWindowLogStrategy(BaseRateLimitStrategy):
+    """Exact sliding window over a sorted set of request timestamps.
+
+    Holds one member per accepted request in the last `period` seconds,
+    so it is best suited to small limits.
+    """
+    name = "sliding_window_log"
+    script = _REPLICATE_COMMANDS + """
+local limit = tonumber(ARGV[1])
+local period = tonumber(ARGV[2]) * 1000
+local cost = tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = time[1] * 1000 + math.floor(time[2] / 1000)
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - period)
+local used = redis.call('ZCARD', KEYS[1])
+local count = used + cost
+if count <= limit then
+    for i = 1, cost do
+        redis.call('ZADD', KEYS[1], now, now .. ':' .. (used + i))
+    end
+    redis.call('PEXPIRE', KEYS[1], period)
+end
+local reset = 0
+local oldest = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+if oldest[2] then
+    reset = math.ceil((tonumber(oldest[2]) + period - now) / 1000)
+end
+return {count, reset}
+"""
+
+
+class SlidingWindowCounterStrategy(BaseRateLimitStrategy):
+    """Approximate sliding window from the current and previous windows.
+
+    The previous window's count is weighted by how much of it still
+    overlaps the sliding window.  Uses one small hash per key.
+    """
+    name = "sliding_window_counter"
+    script = _REPLICATE_COMMANDS + """
+local limit = tonumber(ARGV[1])
+local period = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = time[1] + time[2] / 1000000
+local window = math.floor(now / period)
+local elapsed = (now - window * period) / period
+local current = tonumber(redis.call('HGET', KEYS[1], window)) or 0
+local previous = tonumber(redis.call('HGET', KEYS[1], window - 1)) or 0
+local count = math.floor(previous * (1 - elapsed)) + current + cost
+if count <= limit then
+    redis.call('HINCRBY', KEYS[1], window, cost)
+    redis.call('EXPIRE', KEYS[1], period * 2)
+end
+if redis.call('HLEN', KEYS[1]) > 2 then
+    for _, field in ipairs(redis.call('HKEYS', KEYS[1])) do
+        if tonumber(field) < window - 1 then
+            redis.call('HDEL', KEYS[1], field)
+        end
+    end
+end
+return {count, math.ceil((window + 1) * period - now)}
+"""
+
+
+class TokenBucketStrategy(BaseRateLimitStrategy):
+    """Bucket of `limit` tokens refilled evenly over `period` seconds.
+
+    Allows bursts up to `limit` while smoothing the sustained rate, so
+    there is no spike when a window resets.  Uses one small hash per key.
+    """
+    name = "token_bucket"
+    script = _REPLICATE_COMMANDS + """
+local capacity = tonumber(ARGV[1])
+local period = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local rate = capacity / period
+local time = redis.call('TIME')
+local now = time[1] + time[2] / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local count = capacity + cost
+if tokens >= cost then
+    tokens = tokens - cost
+    count = capacity - math.floor(tokens)
+    redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+    redis.call('EXPIRE', KEYS[1], math.ceil(period))
+end
+return {count, math.ceil((capacity - tokens) / rate)}
+"""
+
+
+def get_strategy(name):
+    """Return the strategy class registered as `name`."""
+    try:
+        return RATE_LIMIT_STRATEGIES[name]
+    except KeyError:
+        raise Exception("'{}' is not a valid rate limit strategy: {}".format(
+            name, sorted(RATE_LIMIT_STRATEGIES.keys())))
@@ -3,13 +3,40 @@ import os
 
 from flask import current_app
 from flask_login import current_user
-from powernap.helpers import redis_connection, model_attrs
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+
+from powernap.helpers import (
+    LRUCache,
+    decode_object,
+    model_attrs,
+    redis_connection,
+)
+
+
+# Seconds a hash from `make_hash` stays reserved before it is issued.
+TOKEN_RESERVATION_EXPIRE = 60
+
+# Members of the active tokens set checked for expiry on each issuance.
+TOKEN_PRUNE_SAMPLE = 10
+
+# Delete the tokens `KEYS[2..]` and remove them from the active tokens set
+# `KEYS[1]`.
+REVOKE_TOKENS_SCRIPT = """
+for i = 2, #KEYS do
+    redis.call('DEL', KEYS[i])
+    redis.call('SREM', KEYS[1], KEYS[i])
+end
+return #KEYS - 1
+"""
 
 
 class TempToken(object):
     """Facilitate creating a temporary token hash to be stored in redis."""
-    def __init__(self):
+    def __init__(self, **kwargs):
         self.redis = redis_connection()
+        for k, v in kwargs.items():
+            setattr(self, k, v)
 
     @staticmethod
     def keys():
@@ -25,19 +52,29 @@ class TempToken(object):
 
     @classmethod
     def retrieve(cls, token, redis=None):
+        return cls.retrieve_with_ttl(token, redis)[0]
+
+    @classmethod
+    def retrieve_with_ttl(cls, token, redis=None):
+        """Return the token and its seconds to expiry in one round trip."""
         redis = redis if redis else redis_connection()
-        data = redis.hgetall(token)
+        pipe = redis.pipeline(transaction=False)
+        pipe.hgetall(token)
+        pipe.ttl(token)
+        data, ttl = pipe.execute()
+        data = decode_object(data)
         temp_token = cls()
-        for k in TempToken.keys:
-            setattr(temp_token, k, getattr(data, k, None))
-        return temp_token
+        for k in TempToken.keys():
+            setattr(temp_token, k, data.get(k))
+        return temp_token, ttl
 
     @staticmethod
     def delete(token):
-        redis = redis_connection()
-        redis.delete(token)
-        key = active_tokens_key(current_user)
-        redis.srem(key, token)
+        pipe = redis_connection().pipeline()
+        pipe.delete(token)
+        pipe.srem(active_tokens_key(current_user), token)
+        pipe.execute()
+        invalidate_token_user(token)
 
     def api_response(self):
         return self.token_data
@@ -52,7 +89,11 @@ def active_tokens_key(user):
 
 
 def make_hash(redis=None):
-    """Return a random hash that does not exist as a token.
+    """Return a random hash reserved as a token.
+
+    The hash is claimed with `SET NX` so concurrent callers can never be
+    handed the same token.  The reservation expires after
+    `TOKEN_RESERVATION_EXPIRE` seconds if the token is never issued.
 
     :param redis: An active redis connection. If None creates its own
         connection.
@@ -61,7 +102,7 @@ def make_hash(redis=None):
     count = 0
     while count < 100:
         token = hashlib.sha1(os.urandom(64)).hexdigest()
-        if not redis.get(token):
+        if redis.set(token, "", nx=True, ex=TOKEN_RESERVATION_EXPIRE):
             return token
         count += 1
     raise Exception("Unable to generate unique hash.")
@@ -69,15 +110,32 @@ def make_hash(redis=None):
 
 def create_temp_token_from_hash_func(user, hash_func, temp_token_cls=None,
                                      **kwargs):
-    """Create expiring auth token in redis. `config['TOKEN_EXPIRE']`."""
+    """Create expiring auth token in redis. `config['TOKEN_EXPIRE']`.
+
+    The token hash, its expiry and the user's active tokens set are
+    written in one MULTI/EXEC pipeline, which also samples
+    `TOKEN_PRUNE_SAMPLE` members of the active set (setting, defaults to
+    `10`) whose expired tokens are then removed.
+    """
     redis = redis_connection()
     token = hash_func(redis)
     temp_token = (temp_token_cls or TempToken).create(user)
     data = temp_token.token_data
     data.update(kwargs)
-    redis.hmset(token, data)
-    redis.sadd(active_tokens_key(user), token)
-    redis.expire(token, current_app.config['TOKEN_EXPIRE'])
+    expire = current_app.config['TOKEN_EXPIRE']
+    key = active_tokens_key(user)
+
+    pipe = redis.pipeline()
+    # Replace the placeholder value left by `make_hash`.
+    pipe.delete(token)
+    pipe.hmset(token, data)
+    pipe.expire(token, expire)
+    pipe.sadd(key, token)
+    pipe.expire(key, expire)
+    pipe.srandmember(
+        key, current_app.config.get('TOKEN_PRUNE_SAMPLE', TOKEN_PRUNE_SAMPLE))
+    sample = pipe.execute()[-1]
+    _prune_tokens(redis, key, [t for t in sample if decode_object(t) != token])
     return token
 
 
@@ -86,6 +144,48 @@ def create_temp_token(user, temp_token_cls=None, **kwargs):
         user, make_hash, temp_token_cls, **kwargs)
 
 
+def revoke_all_tokens(user):
+    """Delete every active token of `user`, e.g. to log out all sessions.
+
+    The tokens are read from the active set and deleted by one script that
+    is passed every key it touches.  Tokens issued in between are left
+    intact.  Returns the number of tokens revoked.
+    """
+    redis = redis_connection()
+    key = active_tokens_key(user)
+    tokens = decode_object(list(redis.smembers(key)))
+    if not tokens:
+        return 0
+    redis.register_script(REVOKE_TOKENS_SCRIPT)(keys=[key] + tokens)
+    for token in tokens:
+        invalidate_token_user(token)
+    return len(tokens)
+
+
+def prune_active_tokens(user):
+    """Remove expired tokens from `user`'s active tokens set.
+
+    Checks every member of the set.  Returns the number of tokens removed.
+    """
+    redis = redis_connection()
+    key = active_tokens_key(user)
+    return _prune_tokens(redis, key, list(redis.smembers(key)))
+
+
+def _prune_tokens(redis, key, tokens):
+    """Remove the expired ones of `tokens` from the active tokens set `key`."""
+    if not tokens:
+        return 0
+    pipe = redis.pipeline(transaction=False)
+    for token in tokens:
+        pipe.exists(token)
+    expired = [token for token, exists in zip(tokens, pipe.execute())
+               if not exists]
+    if expired:
+        redis.srem(key, *expired)
+    return len(expired)
+
+
 def request_user_wrapper(f):
     def inner(request):
         key = current_app.config.get("AUTH_HEADER", "X-Auth")
@@ -94,9 +194,82 @@ def request_user_wrapper(f):
 
 
 def user_from_redis_token_wrapper(user_class, temp_token_cls=None):
+    """Return a flask_login loader of `user_class` instances from tokens.
+
+    When `TOKEN_USER_CACHE_TTL` is set, the user's primary key is cached
+    per token in process so the token hash is not read on every request.
+    With `TOKEN_USER_CACHE_SNAPSHOT` the user's column values are cached
+    as well and the user is merged into the session without a query.
+    """
     def user_from_redis_token(token, redis=None):
-        redis = redis if redis else redis_connection()
-        temp_token = (temp_token_cls or TempToken).retrieve(token)
-        pk = getattr(temp_token, current_app.config["active_tokens_attr"])
+        if not token:
+            return None
+        cache = token_user_cache()
+        entry = cache.get(token) if cache is not None else None
+        if entry is None:
+            temp_token, ttl = (temp_token_cls or TempToken).retrieve_with_ttl(
+                token, redis)
+            pk = getattr(temp_token, current_app.config["active_tokens_attr"])
+            if pk is None or cache is None:
+                return user_class.query.get(pk) if pk is not None else None
+            user = user_class.query.get(pk)
+            snapshot = None
+            if user is not None and \
+                    current_app.config.get("TOKEN_USER_CACHE_SNAPSHOT", False):
+                snapshot = user_snapshot(user)
+            cache.set(token, (pk, snapshot),
+                      ttl=min(cache.ttl, ttl) if ttl > 0 else None)
+            return user
+        pk, snapshot = entry
+        if snapshot is not None:
+            return user_from_snapshot(user_class, snapshot)
         return user_class.query.get(pk)
     return user_from_redis_token
+
+
+_token_users = None
+_token_users_pid = None
+
+
+def token_user_cache():
+    """Return the process's token to user cache or None if disabled.
+
+    Settings:
+        `TOKEN_USER_CACHE_TTL`: Seconds a token stays cached. `0` (the
+            default) disables the cache.  Tokens revoked in another worker
+            are honored once this expires.
+        `TOKEN_USER_CACHE_SIZE`: Max tokens cached per worker.
+    """
+    global _token_users, _token_users_pid
+    ttl = current_app.config.get("TOKEN_USER_CACHE_TTL", 0)
+    if not ttl:
+        return None
+    if _token_users is None or _token_users_pid != os.getpid():
+        _token_users = LRUCache(
+            current_app.config.get("TOKEN_USER_CACHE_SIZE", 10000), ttl=ttl)
+        _token_users_pid = os.getpid()
+    return _token_users
+
+
+def invalidate_token_user(token):
+    """Drop `token` from this worker's token user cache."""
+    if _token_users is not None:
+        _token_users.pop(token)
+
+
+def user_snapshot(user):
+    """Return a dict of the loaded column values of `user`."""
+    return {attr.key: getattr(user, attr.key)
+            for attr in inspect(user).mapper.column_attrs}
+
+
+def user_from_snapshot(user_class, snapshot):
+    """Attach a `user_class` instance built from `snapshot` to the session.
+
+    Uses `merge(load=False)` so no query is emitted.
+    """
+    user = inspect(user_class).class_manager.new_instance()
+    for key, value in snapshot.items():
+        setattr(user, key, value)
+    make_transient_to_detached(user)
+    return user_class.query.session.merge(user, load=False)
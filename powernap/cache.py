@@ -0,0 +1,210 @@
+"""Cache serialized `GET` responses for the `cache` decorator.
+
+Responses are invalidated with a generation counter per table, which
+:meth:`powernap.mixins.PowernapMixin.save` and `delete` increment.  A cached
+response stores the generations of the tables it was built from and is
+only served while they are unchanged, so it is never staler than the
+last save.
+"""
+import hashlib
+import json
+import os
+
+from flask import Response, current_app, g, request
+from flask_login import current_user
+from sqlalchemy import inspect
+
+from powernap.helpers import LRUCache, model_attrs, redis_connection
+
+GENERATION_KEY = 'powernap:generation:{}'
+
+# Tables learned from the responses of each endpoint.
+_endpoint_tables = {}
+
+# Set once a route in this process caches its responses.
+_cached_routes = False
+
+
+def model_tables(model):
+    """Return the names of the tables `model` is mapped to."""
+    return [table.name for table in inspect(model).tables]
+
+
+def bump_generations(model):
+    """Invalidate cached responses holding rows of `model`.
+
+    Called after the write is committed, so redis errors are logged
+    instead of raised.
+
+    Setting: `RESPONSE_CACHE_INVALIDATE`, `True` or `False` to always or
+        never invalidate.  Defaults to invalidating in processes that
+        registered a route with the `cache` option.
+    """
+    invalidate = current_app.config.get('RESPONSE_CACHE_INVALIDATE')
+    if not (_cached_routes if invalidate is None else invalidate):
+        return
+    try:
+        pipe = redis_connection().pipeline(transaction=False)
+        for table in model_tables(model):
+            pipe.incr(GENERATION_KEY.format(table))
+        pipe.execute()
+    except Exception as e:
+        current_app.logger.warning(
+            'Response cache invalidation failed: {}'.format(str(e)))
+
+
+def generations(tables):
+    """Return a dict of the current generation of each table."""
+    tables = sorted(tables)
+    if not tables:
+        return {}
+    values = redis_connection().mget(
+        [GENERATION_KEY.format(table) for table in tables])
+    return {table: int(value or 0) for table, value in zip(tables, values)}
+
+
+def cache_policy(cache):
+    """Return the `cache` decorator option as `{'ttl': ..., 'models': ...}`.
+
+    :param cache: `True` for the `RESPONSE_CACHE_TTL` setting, seconds, or
+        a dict with `ttl` and `models` whose saves also invalidate the
+        response besides the models it returns.
+    """
+    global _cached_routes
+    if not cache:
+        return None
+    _cached_routes = True
+    if cache is True:
+        cache = {}
+    elif not isinstance(cache, dict):
+        cache = {'ttl': int(cache)}
+    return {'ttl': cache.get('ttl'), 'models': list(cache.get('models', []))}
+
+
+def cache_key(prefix='powernap:response'):
+    """Return the cache key of the current request.
+
+    Covers the path, the query args (including excluded properties) and
+    the owner id that :func:`powernap.query.transformer.override_owner_id`
+    would filter by.
+    """
+    user_attr, _ = model_attrs()
+    args = sorted(request.args.items(multi=True))
+    exclude = sorted(k for k, _ in args if k.endswith('__exclude'))
+    owner = (getattr(current_user, 'is_admin', False),
+             getattr(current_user, user_attr, None))
+    key = repr((request.path, args, exclude, owner))
+    return '{}:{}'.format(prefix, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+
+# Headers that are not shared between requests.  Rate limit headers and
+# `Date` are recomputed for each request.
+SKIP_HEADERS = ('content-length', 'date', 'set-cookie', 'x-ratelimit-limit',
+                'x-ratelimit-remaining', 'x-ratelimit-reset')
+
+
+def response_entry(res):
+    """Return a JSON serializable dict of a view's response, or None.
+
+    Only complete `200` responses can be shared between requests.
+    """
+    resp = res[0] if isinstance(res, tuple) else res
+    if not isinstance(resp, Response) or resp.status_code != 200 or \
+            resp.is_streamed:
+        return None
+    return {
+        'body': resp.get_data(as_text=True),
+        'status': resp.status_code,
+        'headers': [[k, v] for k, v in resp.headers.items()
+                    if k.lower() not in SKIP_HEADERS],
+    }
+
+
+def entry_response(entry):
+    """Return the view response of an entry from :func:`response_entry`.
+
+    Gets the current user's rate limit headers and can be a `304`.
+    """
+    from powernap.auth.rate_limit import RateLimiter
+
+    resp = Response(entry['body'], entry['status'], entry['headers'])
+    resp.headers.extend(RateLimiter(current_user).headers())
+    if resp.headers.get('ETag'):
+        resp.make_conditional(request)
+    return resp, resp.status_code
+
+
+class ResponseCache(object):
+    """Store responses in redis or in each worker's LRU cache."""
+    def __init__(self, backend='local', maxsize=1024):
+        self.backend = backend
+        self.local = LRUCache(maxsize) if backend != 'redis' else None
+
+    def get(self, key):
+        if self.local is not None:
+            return self.local.get(key)
+        value = redis_connection().get(key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, entry, generations, ttl):
+        entry = dict(entry, generations=generations)
+        if self.local is not None:
+            self.local.set(key, entry, ttl=ttl)
+        else:
+            redis_connection().setex(key, ttl, json.dumps(entry))
+
+    def __call__(self, func, policy, *args, **kwargs):
+        """Return the cached response of `func` or call and cache it."""
+        endpoint = request.endpoint
+        tables = set(_endpoint_tables.get(endpoint, ()))
+        for model in policy['models']:
+            tables.update(model_tables(model))
+        current = generations(tables)
+        key = cache_key()
+        entry = self.get(key)
+        if entry is not None and entry['generations'] == current:
+            return entry_response(entry)
+
+        g.cache_response = True
+        try:
+            res = func(*args, **kwargs)
+        finally:
+            g.pop('cache_response', None)
+            models = g.pop('response_models', None)
+        entry = response_entry(res)
+        if models is None or entry is None:
+            return res
+        returned = {table for model in models for table in model_tables(model)}
+        if not returned <= set(current):
+            # Generations must be read before the query, so responses are
+            # only cached once the endpoint's tables are known.
+            _endpoint_tables[endpoint] = tables | returned
+            return res
+        if not current:
+            # Nothing would invalidate a response without tables.
+            return res
+        ttl = policy['ttl'] or current_app.config.get('RESPONSE_CACHE_TTL', 60)
+        self.set(key, entry, current, ttl)
+        return res
+
+
+_cache = None
+_cache_pid = None
+
+
+def response_cache():
+    """Return the process's :class:`ResponseCache`.
+
+    Settings:
+        `RESPONSE_CACHE`: `redis` to share responses between workers,
+            otherwise they are cached in each worker.
+        `RESPONSE_CACHE_SIZE`: Max responses cached per worker.
+        `RESPONSE_CACHE_TTL`: Default seconds a response is cached.
+    """
+    global _cache, _cache_pid
+    if _cache is None or _cache_pid != os.getpid():
+        _cache = ResponseCache(
+            current_app.config.get('RESPONSE_CACHE', 'local'),
+            current_app.config.get('RESPONSE_CACHE_SIZE', 1024))
+        _cache_pid = os.getpid()
+    return _cache
@@ -0,0 +1,157 @@
+"""Share one response between identical concurrent `GET` requests.
+
+Requests are identical when they have the same
+:func:`powernap.cache.cache_key` (path, query args and owner).  The first
+request computes the response while the others wait for its serialized
+body, then send it with their own rate limit headers.  Only requests that
+arrive while a response is being computed share it, so responses are
+never staler than without coalescing.
+"""
+import json
+import os
+import threading
+import time
+import uuid
+
+from flask import current_app
+
+from powernap.cache import cache_key, entry_response, response_entry
+from powernap.helpers import redis_connection
+
+# Delete the lock only if this flight still holds it.
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class _Flight(object):
+    """A response being computed by one request of a worker."""
+    def __init__(self):
+        self.done = threading.Event()
+        self.entry = None
+
+
+class SingleFlight(object):
+    """Coalesce requests within a worker and optionally across workers.
+
+    Across workers the first request takes a short redis lock and publishes
+    its response in a result slot that the other workers poll.  Waiting
+    requests that time out, or whose leader fails, compute the response
+    themselves.
+    """
+    poll_interval = 0.01
+
+    def __init__(self, use_redis=False, timeout=5, lock_ms=5000,
+                 result_ms=1000):
+        """
+        :param use_redis: (bool): Also coalesce requests of other workers.
+        :param timeout: (float): Seconds a request waits for a response.
+        :param lock_ms: (int): Expiry of the redis lock, in case its
+            holder dies.
+        :param result_ms: (int): How long waiting workers can read the
+            result slot.
+        """
+        self.use_redis = use_redis
+        self.timeout = timeout
+        self.lock_ms = lock_ms
+        self.result_ms = result_ms
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._release = None
+
+    def __call__(self, func, *args, **kwargs):
+        """Return the response of `func`, shared with identical requests."""
+        key = cache_key('powernap:coalesce')
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            if flight.done.wait(self.timeout) and flight.entry is not None:
+                return entry_response(flight.entry)
+            return func(*args, **kwargs)
+        try:
+            res = self.lead(key, func, *args, **kwargs)
+            flight.entry = response_entry(res)
+            return res
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+
+    def lead(self, key, func, *args, **kwargs):
+        """Compute the worker's response, or wait for another worker's."""
+        if not self.use_redis:
+            return func(*args, **kwargs)
+        redis = redis_connection()
+        lock_key = '{}:lock'.format(key)
+        flight_id = uuid.uuid4().hex
+        if not redis.set(lock_key, flight_id, nx=True, px=self.lock_ms):
+            other = redis.get(lock_key)
+            if other is not None:
+                entry = self.wait(redis, key, lock_key, _decode(other))
+                if entry is not None:
+                    return entry_response(entry)
+            return func(*args, **kwargs)
+        try:
+            res = func(*args, **kwargs)
+            entry = response_entry(res)
+            if entry is not None:
+                redis.set('{}:result:{}'.format(key, flight_id),
+                          json.dumps(entry), px=self.result_ms)
+            return res
+        finally:
+            if self._release is None:
+                self._release = redis.register_script(RELEASE_LOCK_SCRIPT)
+            self._release(keys=[lock_key], args=[flight_id])
+
+    def wait(self, redis, key, lock_key, flight_id):
+        """Return the entry published by flight `flight_id` or None."""
+        result_key = '{}:result:{}'.format(key, flight_id)
+        deadline = time.monotonic() + self.timeout
+        while time.monotonic() < deadline:
+            pipe = redis.pipeline(transaction=False)
+            pipe.get(result_key)
+            pipe.get(lock_key)
+            value, lock = pipe.execute()
+            if value is not None:
+                return json.loads(value)
+            if lock is None or _decode(lock) != flight_id:
+                return None
+            time.sleep(self.poll_interval)
+        return None
+
+
+def _decode(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+_single_flight = None
+_single_flight_pid = None
+
+
+def single_flight():
+    """Return the process's :class:`SingleFlight`.
+
+    Settings:
+        `COALESCE_REDIS`: Also coalesce requests of other workers through
+            redis.  Defaults to `False`.
+        `COALESCE_TIMEOUT`: Seconds a request waits for a shared response.
+        `COALESCE_LOCK_MS`: Expiry of the redis lock.
+        `COALESCE_RESULT_MS`: Expiry of the redis result slot.
+    """
+    global _single_flight, _single_flight_pid
+    if _single_flight is None or _single_flight_pid != os.getpid():
+        config = current_app.config
+        _single_flight = SingleFlight(
+            use_redis=config.get('COALESCE_REDIS', False),
+            timeout=config.get('COALESCE_TIMEOUT', 5),
+            lock_ms=config.get('COALESCE_LOCK_MS', 5000),
+            result_ms=config.get('COALESCE_RESULT_MS', 1000),
+        )
+        _single_flight_pid = os.getpid()
+    return _single_flight
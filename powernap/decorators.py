@@ -1,10 +1,13 @@
 import json
 
-import bleach
-from flask import abort, current_app
+from flask import abort, current_app, g, request
 from flask_login import current_user
 
+from powernap.cache import cache_policy, response_cache
+from powernap.coalesce import single_flight
 from powernap.exceptions import PermissionError, UnauthorizedError
+from powernap.query.counts import get_count_strategy
+from powernap.sanitize import sanitize
 
 
 def public(func, public=False):
@@ -37,31 +40,28 @@ def permission(func, permission=None):
 
 
 def safe(func, safe=False):
-    """Identifies endpoints that don't require sanitization of response data."""
-    def _formatter(*args, **kwargs):
-        res = func(*args, **kwargs)
-        if not safe:
-            def sanitize(data):
-                """This function recursively bleaches all the data.
-
-                This is not optimum, as we have to decode then recode.  This
-                really should be done in the ApiResponse.  Need to rethink how
-                decorators are registered for a route so that bleaching can be
-                done before the response results are rendered.
-                """
-                if isinstance(data, dict):
-                    data = {sanitize(k): sanitize(v) for k, v in data.items()}
-                elif isinstance(data, (list, tuple)):
-                    data = [sanitize(i) for i in data]
-                elif isinstance(data, str):
-                    data = bleach.clean(data)
-                return data
-
-            def clean(res):
-                data = json.loads(res.get_data().decode())
-                data = json.dumps(sanitize(data))
-                res.set_data(data)
+    """Identifies endpoints that don't require sanitization of response data.
 
+    Responses created by `format_` are bleached by the
+    :class:`powernap.architect.responses.APIEncoder` while they are
+    serialized.  Any other response is decoded, bleached and re-encoded.
+    """
+    def _formatter(*args, **kwargs):
+        if safe:
+            return func(*args, **kwargs)
+        g.sanitize_response = True
+        try:
+            res = func(*args, **kwargs)
+        finally:
+            g.pop('sanitize_response', None)
+            sanitized = g.pop('response_sanitized', False)
+
+        def clean(res):
+            data = json.loads(res.get_data().decode())
+            data = json.dumps(sanitize(data))
+            res.set_data(data)
+
+        if not sanitized:
             if isinstance(res, (tuple)):
                 clean(res[0])
             else:
@@ -70,6 +70,73 @@ def safe(func, safe=False):
     return _formatter
 
 
+def stream(func, stream=False):
+    """Identifies endpoints whose list responses are streamed.
+
+    The `format_` decorator then encodes list, query and paginated data
+    one item at a time instead of building the whole body in memory.
+    """
+    def _formatter(*args, **kwargs):
+        if not stream:
+            return func(*args, **kwargs)
+        g.stream_response = True
+        try:
+            return func(*args, **kwargs)
+        finally:
+            g.pop('stream_response', None)
+    return _formatter
+
+
+def count(func, count=None):
+    """Sets how paginated responses of the endpoint count their rows.
+
+    The value is a strategy in
+    :data:`powernap.query.counts.COUNT_STRATEGIES`: `exact`, `cached`,
+    `estimated` or `skip`.  Defaults to the `PAGINATION_COUNT` setting.
+    """
+    if count:
+        get_count_strategy(count)
+
+    def _formatter(*args, **kwargs):
+        if not count:
+            return func(*args, **kwargs)
+        g.count_strategy = count
+        try:
+            return func(*args, **kwargs)
+        finally:
+            g.pop('count_strategy', None)
+    return _formatter
+
+
+def coalesce(func, coalesce=None):
+    """Shares one response between identical concurrent `GET` requests.
+
+    Crudify `GET` and `GET ONE` endpoints default to `True`.  See
+    :mod:`powernap.coalesce`.
+    """
+    def _formatter(*args, **kwargs):
+        if not coalesce or request.method != 'GET':
+            return func(*args, **kwargs)
+        return single_flight()(func, *args, **kwargs)
+    return _formatter
+
+
+def cache(func, cache=None):
+    """Caches the endpoint's `GET` responses.
+
+    `True` caches them for `RESPONSE_CACHE_TTL` seconds, a number for that
+    many seconds, and a dict can set `ttl` and extra `models` whose saves
+    invalidate the response.  See :mod:`powernap.cache`.
+    """
+    policy = cache_policy(cache)
+
+    def _formatter(*args, **kwargs):
+        if not policy or request.method != 'GET':
+            return func(*args, **kwargs)
+        return response_cache()(func, policy, *args, **kwargs)
+    return _formatter
+
+
 def format_(func, format_=True):
     """Decorator to format return values into api responses.
 
@@ -1,4 +1,8 @@
 import importlib
+import os
+import threading
+import time
+from collections import OrderedDict
 
 from redis import Redis, ConnectionPool
 from flask import current_app
@@ -24,16 +28,101 @@ def decode_value(val):
     return val.decode('utf-8') if isinstance(val, bytes) else val
 
 
+_pools = {}
+_pools_lock = threading.Lock()
+_pools_pid = os.getpid()
+
+
 def redis_connection(db=None):
-    settings = current_app.config['REDIS']
+    """Return a redis client backed by a shared, per-process connection pool.
+
+    Pools are kept in a registry keyed by the `REDIS` settings, the db
+    number and the decode mode so every call in a worker reuses the same
+    sockets instead of connecting again.
+
+    Optional settings:
+        `REDIS_MAX_CONNECTIONS`: Upper bound of sockets held by each pool.
+        `REDIS_HEALTH_CHECK_INTERVAL`: Seconds a connection may sit idle
+            before it is checked with a `PING` when taken from the pool.
+    """
+    settings = dict(current_app.config['REDIS'])
     if db is not None:
         settings['db'] = db
-    pool = ConnectionPool(**settings)
     decode_bytes = current_app.config.get("DECODE_REDIS_BYTES", True)
+    key = (_freeze(settings), decode_bytes)
+
+    _reset_pools_after_fork()
+    client = _pools.get(key)
+    if client is None:
+        with _pools_lock:
+            client = _pools.get(key)
+            if client is None:
+                client = _pools[key] = _create_client(settings, decode_bytes)
+    return client
+
+
+def _create_client(settings, decode_bytes):
+    max_connections = current_app.config.get("REDIS_MAX_CONNECTIONS")
+    if max_connections:
+        settings.setdefault('max_connections', max_connections)
+    health_check = current_app.config.get("REDIS_HEALTH_CHECK_INTERVAL")
+    if health_check:
+        settings.setdefault('health_check_interval', health_check)
+    pool = ConnectionPool(**settings)
     cls = DecodedRedis if decode_bytes else Redis
     return cls(connection_pool=pool, decode_responses=True)
 
 
+def _freeze(settings):
+    """Return a hashable, order independent version of `settings`."""
+    return tuple(sorted((k, repr(v)) for k, v in settings.items()))
+
+
+def _reset_pools_after_fork():
+    """Drop pools inherited from a parent process.
+
+    Sockets must never be shared between a preforking server's master and
+    its workers, so a forked child starts with an empty registry.
+    """
+    global _pools_pid
+    if _pools_pid == os.getpid():
+        return
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            _pools.clear()
+            _pools_pid = os.getpid()
+
+
+def redis_pool_stats():
+    """Return usage stats for every redis pool created by this process.
+
+    Each entry identifies the pool by host, port (or unix path) and db and
+    contains the number of `in_use`, `idle` and `created` connections.
+    """
+    _reset_pools_after_fork()
+    stats = []
+    for client in list(_pools.values()):
+        pool = client.connection_pool
+        kwargs = pool.connection_kwargs
+        stats.append({
+            'connection': {k: kwargs[k] for k in ('host', 'port', 'path', 'db')
+                           if k in kwargs},
+            'max_connections': pool.max_connections,
+            'in_use': len(pool._in_use_connections),
+            'idle': len(pool._available_connections),
+            'created': pool._created_connections,
+        })
+    return stats
+
+
+def close_redis_pools():
+    """Disconnect and forget every pool, e.g. in a server's pre-fork hook."""
+    with _pools_lock:
+        for client in _pools.values():
+            client.connection_pool.disconnect()
+        _pools.clear()
+
+
 def load_from_string(path):
     module, decorator_name = path.rsplit(".", 1)
     return getattr(importlib.import_module(module), decorator_name)
@@ -43,3 +132,73 @@ def model_attrs():
     client_key = current_app.config.get("ACTIVE_TOKENS_ATTR", "id")
     db_entry_key = current_app.config.get("DB_ENTRY_ATTR", "id")
     return client_key, db_entry_key
+
+
+class LRUCache(object):
+    """Thread safe mapping that evicts the least recently used keys.
+
+    :param maxsize: (int): Max number of keys held.
+    :param ttl: (float): Seconds before an entry expires. `None` never
+        expires entries.
+    :param on_evict: (func): Called with `(key, value)` for every entry
+        dropped to make room.
+    """
+    def __init__(self, maxsize=1024, ttl=None, on_evict=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[1] is not None and \
+                    item[1] <= time.monotonic():
+                del self._data[key]
+                item = None
+            if item is None:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value, ttl=None):
+        """Store `value`. `ttl` overrides the cache's default ttl."""
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.monotonic() + ttl if ttl is not None else None
+        evicted = []
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                k, item = self._data.popitem(last=False)
+                evicted.append((k, item[0]))
+        if self.on_evict:
+            for k, v in evicted:
+                self.on_evict(k, v)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return default if item is None else item[0]
+
+    def items(self):
+        """Return a list of the `(key, value)` pairs currently held."""
+        with self._lock:
+            return [(k, item[0]) for k, item in self._data.items()]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def stats(self):
+        return {'size': len(self), 'maxsize': self.maxsize,
+                'hits': self.hits, 'misses': self.misses}
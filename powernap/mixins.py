@@ -5,21 +5,54 @@ from flask import current_app
 from flask_sqlalchemy import BaseQuery
 from flask_login import current_user
 
+from powernap.cache import bump_generations
 from powernap.exceptions import OwnerError
 from powernap.helpers import model_attrs
+from powernap.serializers import (
+    api_fields,
+    compile_serializer,
+    serializer_cache,
+)
 
 
 class PowernapMixin(object):
     """
     Mixin that is required for any object that is returned throught the
     `format_` decorator.
+
+    :attr exposed_fields: Fields that can be queried with query args.
+    :attr version_field: Column incremented on every update.  Defaults to
+        the mapper's `version_id_col`.  Gives responses an ETag without
+        serializing them.
+    :attr last_modified_field: Column holding the time of the last update,
+        sent as the `Last-Modified` header.
     """
     query_class = BaseQuery
     exposed_fields = []
+    version_field = None
+    last_modified_field = None
 
     def session(self):
         return self.query.session
 
+    @property
+    def row_version(self):
+        """Return the value of the version column or None."""
+        field = self.version_field
+        if field is None:
+            mapper = sqlalchemy.inspect(self.__class__)
+            if mapper.version_id_col is None:
+                return None
+            field = mapper.get_property_by_column(mapper.version_id_col).key
+        return getattr(self, field)
+
+    @property
+    def row_last_modified(self):
+        """Return the value of the last modified column or None."""
+        if self.last_modified_field is None:
+            return None
+        return getattr(self, self.last_modified_field)
+
     @contextlib.contextmanager
     def session_context(self):
         try:
@@ -30,11 +63,14 @@ class PowernapMixin(object):
             session.rollback()
 
     def delete(self):
+        deleted = False
         with self.session_context() as session:
             session.delete(self)
             session.commit()
-            return True
-        return False
+            deleted = True
+        if deleted:
+            bump_generations(self.__class__)
+        return deleted
 
     @classmethod
     def safe_delete(cls, pk):
@@ -44,11 +80,135 @@ class PowernapMixin(object):
         return True
 
     def save(self):
+        saved = False
         with self.session_context() as session:
             session.add(self)
             session.commit()
-            return self
-        return None
+            saved = True
+        if not saved:
+            return None
+        bump_generations(self.__class__)
+        return self
+
+    @classmethod
+    def save_all(cls, instances):
+        """Add and commit `instances` in one transaction.
+
+        The session flushes rows of the same table in batched statements.
+        Returns the instances, or None if the transaction was rolled back.
+        """
+        session = cls.query.session
+        try:
+            session.add_all(instances)
+            session.commit()
+        except Exception as e:
+            current_app.logger.warning('Rollback: {}'.format(str(e)))
+            session.rollback()
+            return None
+        bump_generations(cls)
+        return instances
+
+    @classmethod
+    def delete_all(cls, instances):
+        """Delete `instances` in one transaction.
+
+        Returns whether the transaction was committed.
+        """
+        session = cls.query.session
+        try:
+            for instance in instances:
+                session.delete(instance)
+            session.commit()
+        except Exception as e:
+            current_app.logger.warning('Rollback: {}'.format(str(e)))
+            session.rollback()
+            return False
+        bump_generations(cls)
+        return True
+
+    @classmethod
+    def delete_where(cls, *criterion, orm_events=False, **filters):
+        """Delete the current user's rows matching `criterion` and `filters`.
+
+        Issues one `DELETE ... WHERE`, which skips ORM events and
+        relationship cascades.  With `orm_events` the rows are loaded and
+        deleted through the session instead, committing every
+        `DELETE_BATCH_SIZE` rows (default `1000`).  Batches are not one
+        transaction: if one fails, the batches before it stay deleted.
+
+        Returns the number of deleted rows, or None if a delete was rolled
+        back.
+        """
+        query = cls.owned_query().filter(*criterion).filter_by(**filters)
+        if orm_events:
+            return cls._delete_batches(query)
+        session = query.session
+        try:
+            count = query.delete(synchronize_session='fetch')
+            session.commit()
+        except Exception as e:
+            current_app.logger.warning('Rollback: {}'.format(str(e)))
+            session.rollback()
+            return None
+        if count:
+            bump_generations(cls)
+        return count
+
+    @classmethod
+    def _delete_batches(cls, query):
+        batch_size = current_app.config.get('DELETE_BATCH_SIZE', 1000)
+        session = query.session
+        count = 0
+        failed = False
+        while True:
+            batch = query.limit(batch_size).all()
+            if not batch:
+                break
+            try:
+                for instance in batch:
+                    session.delete(instance)
+                session.commit()
+            except Exception as e:
+                current_app.logger.warning(
+                    'Rollback after deleting {} rows: {}'.format(count, str(e)))
+                session.rollback()
+                failed = True
+                break
+            count += len(batch)
+        if count:
+            bump_generations(cls)
+        return None if failed else count
+
+    @classmethod
+    def owned_query(cls):
+        """Return `cls.query` limited to the current user's rows.
+
+        Admins, and models without an owner column, are not limited, like
+        the query args of :func:`powernap.query.transformer.construct_query`.
+        """
+        user_attr, db_attr = model_attrs()
+        query = cls.query
+        if not getattr(current_user, 'is_admin', False) and \
+                hasattr(cls, db_attr) and hasattr(current_user, user_attr):
+            query = query.filter(
+                getattr(cls, db_attr) == getattr(current_user, user_attr))
+        return query
+
+    @classmethod
+    def get_owned(cls, ids):
+        """Return a dict of the instances with primary key in `ids`.
+
+        Rows are loaded in one query.  Missing rows, and rows that fail
+        :meth:`confirm_owner`, are left out.
+        """
+        if not ids:
+            return {}
+        mapper = sqlalchemy.inspect(cls)
+        pk = mapper.primary_key[0]
+        key = mapper.get_property_by_column(pk).key
+        instances = cls.query.filter(pk.in_(set(ids))).all()
+        return {getattr(instance, key): instance for instance in instances
+                if instance.confirm_owner(throw=False)}
 
     @classmethod
     def exists(cls, **kwargs):
@@ -89,6 +249,34 @@ class PowernapMixin(object):
         return is_owner
 
 
+class SerializerMixin(object):
+    """Give a model an `api_response` compiled from its fields.
+
+    List it before the classes it should override, e.g.
+    `class MyModel(SerializerMixin, PowernapMixin, db.Model)`.
+
+    :attr api_fields: Fields returned by :meth:`api_response`.  Defaults
+        to `exposed_fields` plus `excludable_properties`.
+    """
+    api_fields = None
+
+    def api_response(self, exclude_properties=None):
+        """Return a dict of `api_fields` minus `exclude_properties`."""
+        return self.api_serializer(exclude_properties)(self)
+
+    @classmethod
+    def api_serializer(cls, exclude_properties=None):
+        """Return the compiled serializer for `cls` and the exclusions."""
+        excluded = frozenset(exclude_properties or ()) & set(api_fields(cls))
+        key = (cls, excluded)
+        cache = serializer_cache()
+        serializer = cache.get(key)
+        if serializer is None:
+            serializer = compile_serializer(cls, excluded)
+            cache.set(key, serializer)
+        return serializer
+
+
 class PowernapFormMixin(object):
     def __init__(self, *args, **kwargs):
         self.instance = kwargs.pop("instance", None)
@@ -103,22 +291,30 @@ class PowernapFormMixin(object):
     def save_obj(self, instance):
         return instance.save()
 
-    def delete_obj(self, model=None, **kwargs):
+    def delete_obj(self, model=None, orm_events=False, **kwargs):
+        """Delete the current user's rows matching the form data.
+
+        Returns the number of deleted rows, or None on failure.  See
+        :meth:`PowernapMixin.delete_where`.
+        """
         if model is None:
             model = self.model()
         self.data.update(**kwargs)
         cleaned = self._clean_data(self.data)
-        for m in model.query.filter_by(**cleaned).all():
-            m.delete()
+        return model.delete_where(orm_events=orm_events, **cleaned)
 
     def commit(self, instance=None, **kwargs):
+        return self.save_obj(self.build_obj(instance, **kwargs))
+
+    def build_obj(self, instance=None, **kwargs):
+        """Populate `instance`, or a new model, without saving it."""
         if instance is None:
             instance = self.model()
         self.populate_obj(instance)
         for k, v in kwargs.items():
             setattr(instance, k, v)
         self.ensure_owner(instance)
-        return self.save_obj(instance)
+        return instance
 
     def ensure_owner(self, instance):
         client_key, db_entry_key = model_attrs()
@@ -0,0 +1,71 @@
+"""Fast membership tests for lists of ip networks."""
+
+import bisect
+import ipaddress
+
+from flask import current_app
+
+
+class NetworkMatcher(object):
+    """Match ipv4 and ipv6 addresses against a list of networks.
+
+    Networks are merged into sorted, non overlapping integer ranges once,
+    so each lookup is a binary search: O(log n) in the number of networks.
+    """
+    def __init__(self, networks):
+        """
+        :param networks: Iterable of network strings or objects accepted by
+            :func:`ipaddress.ip_network`. e.g. `['10.0.0.0/8', '::1']`.
+        """
+        ranges = {4: [], 6: []}
+        for network in networks:
+            network = ipaddress.ip_network(network)
+            ranges[network.version].append(
+                (int(network.network_address),
+                 int(network.broadcast_address)))
+        self._starts = {}
+        self._ends = {}
+        for version, version_ranges in ranges.items():
+            starts, ends = [], []
+            for start, end in sorted(version_ranges):
+                if ends and start <= ends[-1] + 1:
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+            self._starts[version] = starts
+            self._ends[version] = ends
+
+    def __contains__(self, address):
+        """Return True if `address` is inside any network.
+
+        Invalid addresses are never contained.  IPv4 mapped ipv6
+        addresses (`::ffff:1.2.3.4`) are matched as ipv4.
+        """
+        try:
+            address = ipaddress.ip_address(address)
+        except ValueError:
+            return False
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        value = int(address)
+        index = bisect.bisect_right(self._starts[address.version], value) - 1
+        return index >= 0 and value <= self._ends[address.version][index]
+
+    def __bool__(self):
+        return bool(self._starts[4] or self._starts[6])
+
+
+def compile_networks(name):
+    """Return the :class:`NetworkMatcher` of the current app's `name` setting.
+
+    The setting is compiled on first use and kept in `app.extensions`, so
+    like the app's other settings it should be set before the app serves
+    requests.
+    """
+    matchers = current_app.extensions.setdefault('powernap.networks', {})
+    matcher = matchers.get(name)
+    if matcher is None:
+        matcher = matchers[name] = NetworkMatcher(
+            current_app.config.get(name) or ())
+    return matcher
@@ -56,20 +56,40 @@ class BaseQueryColumn(object, metaclass=_QueryMeta):
             raise InvalidFormError(description=errors)
         return True
 
+    @property
+    def plannable(self):
+        """True if :meth:`handle` can be replaced by a cached query plan.
+
+        Subclasses that override `handle`, `handle_method` or
+        `execute_method` are handled on every request instead.
+        """
+        cls = type(self)
+        return cls.handle is BaseQueryColumn.handle and \
+            cls.handle_method is BaseQueryColumn.handle_method and \
+            cls.execute_method is BaseQueryColumn.execute_method
+
+    def convert(self, value):
+        """Return the query arg `value` converted for the column."""
+        return value
+
     def handle(self, column, value, func):
         """Updates the query based on the args."""
         self.check_exposed_column(column, func)
         self.check_excludable_properties(column, func)
-        return self.handle_method(column, value, func)
+        return self.handle_method(column, self.convert(value), func)
 
     def handle_method(self, column, value, func):
         """Updates query with `func` from :module:`powernap.query.methods`."""
+        func = self.resolve_method(func)
+        return self.execute_method(func, self.cls, self.query, column, value)
+
+    def resolve_method(self, func):
+        """Return the :module:`powernap.query.methods` function `func`."""
         from powernap.query import methods
         func = func or "filter_by"
         if func in self.invalid:
             methods.raise_error(keys=func)
-        func = getattr(methods, func)
-        return self.execute_method(func, self.cls, self.query, column, value)
+        return getattr(methods, func)
 
     def execute_method(self, func, cls, query, column, value):
         decorator = current_app.config.get("QUERY_METHOD_DECORATOR")
@@ -102,7 +122,7 @@ class StringQueryColumn(BaseQueryColumn):
 class DateTimeQueryColumn(BaseQueryColumn):
     impl = [DateTime]
 
-    def handle(self, column, value, func):
+    def convert(self, value):
         if isinstance(value, (int, str)):
             value = datetime.fromtimestamp(int(value))
-        return super(DateTimeQueryColumn, self).handle(column, value, func)
+        return value
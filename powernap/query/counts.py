@@ -0,0 +1,189 @@
+"""Strategies for counting the total rows of paginated queries.
+
+The total fills `total` and `last` in the `X-Pagination` header.  An exact
+`COUNT(*)` can cost more than fetching the page itself on big tables, so
+routes can choose a cheaper strategy with the `count` decorator option.
+"""
+import hashlib
+import json
+import os
+
+from flask import current_app
+from flask_sqlalchemy import Pagination
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+from powernap.helpers import LRUCache, redis_connection
+
+COUNT_STRATEGIES = {}
+
+
+class _CountMeta(type):
+    """On import makes `COUNT_STRATEGIES`.
+
+    Key is the strategy's `name` and value is the
+    :class:`.BaseCountStrategy` subclass."""
+    def __init__(cls, name, bases, dct):
+        if dct.get('name'):
+            COUNT_STRATEGIES[dct['name']] = cls
+        super(_CountMeta, cls).__init__(name, bases, dct)
+
+
+class BaseCountStrategy(object, metaclass=_CountMeta):
+    """Paginate a query, counting its rows with :meth:`count`.
+
+    :attr name: Name used to select the strategy in settings and route
+        options.
+    """
+    name = None
+
+    def paginate(self, query, page, per_page):
+        """Return a :class:`flask_sqlalchemy.Pagination` of `query`."""
+        page = max(page, 1)
+        items = query.limit(per_page).offset((page - 1) * per_page).all()
+        # A short first page is the whole result.
+        if page == 1 and len(items) < per_page:
+            total = len(items)
+        else:
+            total = self.count(query)
+        return Pagination(query, page, per_page, total, items)
+
+    def count(self, query):
+        return query.order_by(None).count()
+
+
+class ExactCount(BaseCountStrategy):
+    """`COUNT(*)` the query on every request."""
+    name = "exact"
+
+
+class CachedCount(BaseCountStrategy):
+    """Reuse exact counts of the same query for a few seconds.
+
+    Counts are keyed by the query's SQL and parameters, which include the
+    query args and the owner id, and cached in redis or in each worker.
+    """
+    name = "cached"
+
+    def count(self, query):
+        key = self.cache_key(query)
+        ttl = current_app.config.get('PAGINATION_COUNT_CACHE_TTL', 60)
+        if current_app.config.get('PAGINATION_COUNT_CACHE') == 'redis':
+            redis = redis_connection()
+            total = redis.get(key)
+            if total is None:
+                total = super(CachedCount, self).count(query)
+                redis.setex(key, ttl, total)
+            return int(total)
+        cache = count_cache()
+        total = cache.get(key)
+        if total is None:
+            total = super(CachedCount, self).count(query)
+            cache.set(key, total, ttl=ttl)
+        return total
+
+    def cache_key(self, query):
+        compiled = query.order_by(None).statement.compile()
+        normalized = repr((str(compiled), sorted(compiled.params.items())))
+        return 'powernap:count:{}'.format(
+            hashlib.sha1(normalized.encode('utf-8')).hexdigest())
+
+
+class EstimatedCount(BaseCountStrategy):
+    """Use the postgresql planner's row estimate.
+
+    Estimates below `PAGINATION_COUNT_ESTIMATE_THRESHOLD`, where they are
+    least accurate and counting is cheap, are replaced by an exact count,
+    as are counts on other databases.
+    """
+    name = "estimated"
+
+    def count(self, query):
+        estimate = self.estimate(query)
+        threshold = current_app.config.get(
+            'PAGINATION_COUNT_ESTIMATE_THRESHOLD', 1000)
+        if estimate is None or estimate < threshold:
+            return super(EstimatedCount, self).count(query)
+        return estimate
+
+    def estimate(self, query):
+        """Return the planner's estimate of the rows of `query` or None."""
+        statement = query.order_by(None).statement
+        bind = query.session.get_bind(clause=statement)
+        if bind.dialect.name != 'postgresql':
+            return None
+        plan = query.session.execute(Explain(statement)).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+
+
+class SkipCount(BaseCountStrategy):
+    """Don't count.  Fetch one extra row to know if there is a next page."""
+    name = "skip"
+
+    def paginate(self, query, page, per_page):
+        page = max(page, 1)
+        items = query.limit(per_page + 1).offset((page - 1) * per_page).all()
+        return UncountedPagination(
+            query, page, per_page, items[:per_page], len(items) > per_page)
+
+
+class UncountedPagination(Pagination):
+    """Pagination without a total.  `pages` is only known on the last page."""
+    def __init__(self, query, page, per_page, items, has_next):
+        super(UncountedPagination, self).__init__(
+            query, page, per_page, None, items)
+        self._has_next = has_next
+
+    @property
+    def has_next(self):
+        return self._has_next
+
+    @property
+    def pages(self):
+        return None if self._has_next else self.page
+
+
+class Explain(Executable, ClauseElement):
+    """`EXPLAIN` a statement."""
+    inherit_cache = False
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain, 'postgresql')
+def _explain_postgresql(element, compiler, **kwargs):
+    return 'EXPLAIN (FORMAT JSON) {}'.format(
+        compiler.process(element.statement, **kwargs))
+
+
+_counts = None
+_counts_pid = None
+
+
+def count_cache():
+    """Return the process's cache of `cached` counts.
+
+    Settings:
+        `PAGINATION_COUNT_CACHE`: `redis` to share counts between workers,
+            otherwise they are cached in each worker.
+        `PAGINATION_COUNT_CACHE_TTL`: Seconds a count is reused.
+        `PAGINATION_COUNT_CACHE_SIZE`: Max counts cached per worker.
+    """
+    global _counts, _counts_pid
+    if _counts is None or _counts_pid != os.getpid():
+        _counts = LRUCache(
+            current_app.config.get('PAGINATION_COUNT_CACHE_SIZE', 1024))
+        _counts_pid = os.getpid()
+    return _counts
+
+
+def get_count_strategy(name):
+    """Return an instance of the count strategy registered as `name`."""
+    try:
+        return COUNT_STRATEGIES[name]()
+    except KeyError:
+        raise Exception("'{}' is not a valid count strategy: {}".format(
+            name, sorted(COUNT_STRATEGIES.keys())))
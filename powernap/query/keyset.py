@@ -0,0 +1,175 @@
+"""Keyset (cursor) pagination for :class:`.transformer.QueryTransformer`.
+
+Pages are selected with a `WHERE` on the sort columns of the last row seen
+instead of an `OFFSET`, so every page costs the same however deep it is.
+The sort is the `$order_by` columns followed by the primary key, which
+makes it total.  Sort columns should not be nullable.
+
+Cursors hold the sort values of a row, so only exposed fields, including
+the primary key, can be sorted on, and are signed with the app's
+`SECRET_KEY` so clients can't craft them to probe other values.
+"""
+from datetime import date, datetime, time, timedelta, timezone
+from decimal import Decimal, InvalidOperation
+
+from flask import current_app
+from itsdangerous import BadData, URLSafeSerializer
+from sqlalchemy import and_, inspect, or_
+from sqlalchemy.types import Date, DateTime, Numeric, Time
+
+from powernap.exceptions import InvalidFormError
+
+
+class KeysetPagination(object):
+    """A page of a keyset paginated query.
+
+    :attr items: The rows of the page.
+    :attr next_cursor: Cursor for the following page, or None.
+    :attr prev_cursor: Cursor for the preceding page, or None.
+    :attr total: Number of rows of the query, or None if not counted.
+    :attr query: The paginated query.
+    """
+    def __init__(self, items, per_page, next_cursor=None, prev_cursor=None,
+                 total=None, query=None):
+        self.items = items
+        self.query = query
+        self.per_page = per_page
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.total = total
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+class Keyset(object):
+    """The sort of a keyset paginated query of `cls`."""
+    def __init__(self, cls, order_by=None):
+        """
+        :param order_by: (string): Comma separated column names, prefixed
+            with `-` for descending order, as passed to `$order_by`.
+        """
+        if not current_app.secret_key:
+            raise Exception("Keyset pagination needs the app's SECRET_KEY "
+                            "to sign cursors.")
+        self.cls = cls
+        mapper = inspect(cls)
+        self.columns = []
+        for name in (order_by or '').split(','):
+            name = name.strip()
+            desc = name.startswith('-')
+            name = name.lstrip('-')
+            if not name:
+                continue
+            check_exposed(cls, name)
+            attr = mapper.column_attrs.get(name)
+            if attr is None:
+                msg = "Invalid Value: '{}' is not a column".format(name)
+                errors = {'query_construction': [msg]}
+                raise InvalidFormError(description=errors)
+            self.columns.append((name, attr.columns[0], desc))
+        names = [name for name, _, _ in self.columns]
+        for column in mapper.primary_key:
+            name = mapper.get_property_by_column(column).key
+            if name not in names:
+                check_exposed(cls, name)
+                self.columns.append((name, column, False))
+
+    def order(self, query, reverse=False):
+        """Return `query` sorted by the keyset, replacing any sort."""
+        clauses = []
+        for name, _, desc in self.columns:
+            attr = getattr(self.cls, name)
+            clauses.append(attr.asc() if desc == reverse else attr.desc())
+        return query.order_by(None).order_by(*clauses)
+
+    def filter(self, query, cursor, reverse=False):
+        """Return `query` filtered to the rows after `cursor`.
+
+        With `reverse` the rows before it.  Expands to
+        `a > x OR (a = x AND b > y) ...` so columns can mix directions.
+        """
+        values = self.decode(cursor)
+        clauses = []
+        for i, (name, _, desc) in enumerate(self.columns):
+            attr = getattr(self.cls, name)
+            equal = [getattr(self.cls, n) == v for (n, _, _), v in
+                     zip(self.columns[:i], values)]
+            after = attr < values[i] if desc != reverse else attr > values[i]
+            clauses.append(and_(*equal, after))
+        return query.filter(or_(*clauses))
+
+    def cursor(self, item):
+        """Return the opaque cursor pointing at `item`."""
+        values = [_dump_value(getattr(item, name))
+                  for name, _, _ in self.columns]
+        return _serializer().dumps(values)
+
+    def decode(self, cursor):
+        """Return the column values of `cursor`."""
+        try:
+            values = _serializer().loads(cursor)
+            if not isinstance(values, list) or \
+                    len(values) != len(self.columns):
+                raise ValueError(cursor)
+            return [_load_value(column, value) for (_, column, _), value
+                    in zip(self.columns, values)]
+        except (BadData, TypeError, ValueError, InvalidOperation):
+            errors = {'query_construction': ["Invalid Value: cursor"]}
+            raise InvalidFormError(description=errors)
+
+
+def check_exposed(cls, name):
+    """Raise :class:`InvalidFormError` unless `name` is an exposed field."""
+    if name not in cls.exposed_fields:
+        errors = {'fields': {name: ["Invalid Argument: Field not exposed"]}}
+        raise InvalidFormError(description=errors)
+
+
+def _serializer():
+    return URLSafeSerializer(current_app.secret_key, salt='powernap.keyset')
+
+
+# Dates and times are stored as their fields, plus the utc offset in
+# seconds, instead of iso strings which python < 3.7 can't parse.
+def _dump_value(value):
+    if isinstance(value, datetime):
+        return [value.year, value.month, value.day, value.hour,
+                value.minute, value.second, value.microsecond,
+                _dump_offset(value)]
+    if isinstance(value, date):
+        return [value.year, value.month, value.day]
+    if isinstance(value, time):
+        return [value.hour, value.minute, value.second, value.microsecond,
+                _dump_offset(value)]
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+def _dump_offset(value):
+    offset = value.utcoffset()
+    return None if offset is None else int(offset.total_seconds())
+
+
+def _load_value(column, value):
+    if value is None:
+        return None
+    if isinstance(column.type, DateTime):
+        return datetime(*value[:7], tzinfo=_load_offset(value[7]))
+    if isinstance(column.type, Date):
+        return date(*value)
+    if isinstance(column.type, Time):
+        return time(*value[:4], tzinfo=_load_offset(value[4]))
+    if isinstance(column.type, Numeric) and column.type.asdecimal:
+        return Decimal(value)
+    return value
+
+
+def _load_offset(seconds):
+    return None if seconds is None else timezone(timedelta(seconds=seconds))
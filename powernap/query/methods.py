@@ -16,7 +16,10 @@ You would define the method:
 """
 import json
 
-from sqlalchemy import func, inspect
+from flask import current_app
+from sqlalchemy import all_, any_, bindparam, func, inspect
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.types import Integer, String
 
 from sqlalchemy.exc import InvalidRequestError
 from sqlalchemy.orm.util import _ORMJoin
@@ -86,23 +89,99 @@ def icontains(cls, query, column, value):
 
 
 def inside(cls, query, column, value):
-    """Return in_ query."""
+    """Return in_ query.  `value` is a JSON list, see :func:`inside_clause`."""
+    values = inside_values(column, value)
+    if values is None:
+        return query
+    # Catching all exceptions is bad, but invalid columns were always
+    # ignored here.
     try:
-        return query.filter(getattr(cls, column).in_(json.loads(value)))
-    # Catching all exceptions is bad.  We'd like to catch
-    # json.decoder.JSONDecodeError but doesn't exists below python3.5.
-    except (TypeError, ValueError, Exception):
+        clause = inside_clause(cls, query, column, values)
+    except InvalidFormError:
+        raise
+    except Exception:
         return query
+    return query.filter(clause)
 
 
 def not_inside(cls, query, column, value):
-    """Return ~in_ query."""
+    """Return ~in_ query.  `value` is a JSON list."""
+    values = inside_values(column, value)
+    if values is None:
+        return query
     try:
-        return query.filter(~getattr(cls, column).in_(json.loads(value)))
-    # Catching all exceptions is bad.  We'd like to catch
-    # json.decoder.JSONDecodeError but doesn't exists below python3.5.
-    except (TypeError, ValueError, Exception):
+        clause = inside_clause(cls, query, column, values, negate=True)
+    except InvalidFormError:
+        raise
+    except Exception:
         return query
+    return query.filter(clause)
+
+
+def inside_values(column, value):
+    """Return the unique values of the JSON list `value` or None if invalid.
+
+    Raises :class:`powernap.exceptions.InvalidFormError` for lists longer
+    than `QUERY_INSIDE_MAX_VALUES`.
+    """
+    try:
+        values = json.loads(value)
+        if not isinstance(values, list):
+            return None
+        values = list(dict.fromkeys(values))
+    except (TypeError, ValueError):
+        return None
+    check_inside_size(column, values,
+                      current_app.config.get('QUERY_INSIDE_MAX_VALUES', 10000))
+    return values
+
+
+def check_inside_size(column, values, max_values):
+    if len(values) > max_values:
+        msg = "Invalid Value: {} accepts at most {} values".format(
+            column, max_values)
+        raise InvalidFormError(description={'query_construction': [msg]})
+
+
+def inside_clause(cls, query, column, values, negate=False):
+    """Return a clause testing if `column` is (not) in `values`.
+
+    Lists are bound as a single expanding parameter, so the statement is
+    the same whatever their length.  Lists longer than
+    `QUERY_INSIDE_ARRAY_THRESHOLD` are bound as one array on postgresql.
+    Other lists still bind a parameter per value, so they are limited to
+    :func:`bind_limit` values.
+    """
+    attr = getattr(cls, column)
+    dialect = query.session.get_bind(mapper=inspect(cls)).dialect
+    threshold = current_app.config.get('QUERY_INSIDE_ARRAY_THRESHOLD', 1000)
+    if len(values) > threshold and binds_arrays(dialect, attr):
+        array = bindparam(column, values, type_=ARRAY(attr.type), unique=True)
+        return attr != all_(array) if negate else attr == any_(array)
+    limit = bind_limit(dialect)
+    if limit is not None:
+        check_inside_size(column, values, limit)
+    clause = attr.in_(bindparam(column, values, expanding=True, unique=True))
+    return ~clause if negate else clause
+
+
+def binds_arrays(dialect, attr):
+    """Return True if `attr` values can be bound as one array."""
+    return dialect.name == 'postgresql' and \
+        isinstance(attr.type, (Integer, String))
+
+
+def bind_limit(dialect):
+    """Return how many values an `IN` list can bind on `dialect` or None.
+
+    Leaves room for the other parameters of the query.
+    """
+    if dialect.name == 'mssql':
+        return 2000
+    if dialect.name == 'sqlite':
+        version = getattr(dialect.dbapi, 'sqlite_version_info', (0,))
+        return 900 if version < (3, 32) else 32000
+    return None
 
 
 def gt(cls, query, column, value):
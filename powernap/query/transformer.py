@@ -1,12 +1,21 @@
+import os
 from collections import deque
 
-from flask import current_app, request, session
+from flask import current_app, g, request, session
 from flask_login import current_user
-from sqlalchemy import exc
+from sqlalchemy import exc, inspect
+from sqlalchemy.orm import defer
 
 from powernap.exceptions import InvalidFormError
-from powernap.helpers import load_from_string, model_attrs
+from powernap.helpers import LRUCache, load_from_string, model_attrs
+from powernap.mixins import SerializerMixin
 from powernap.query.columns import BaseQueryColumn, QUERY_COLUMNS
+from powernap.query.counts import get_count_strategy
+from powernap.query.keyset import Keyset, KeysetPagination
+from powernap.serializers import api_fields
+
+# `$per_page` value that returns every row instead of a page.
+ALL_ROWS = 'all'
 
 
 def construct_query(cls, enforce_owner=True, **kwargs):
@@ -37,7 +46,7 @@ def extend_query(query, enforce_owner=True, ignore=[], **kwargs):
     an existing query, like for objects that require complex queries to be
     constructed intitially.
     """
-    cls = query._primary_entity.type
+    cls = query.column_descriptions[0]['entity']
     query_args = get_query_args_for_cls(
         cls, enforce_owner=enforce_owner, **kwargs)
     for arg in ignore:
@@ -74,12 +83,21 @@ class QueryTransformer:
     query_columns = QUERY_COLUMNS
 
     def __init__(self, cls=None, query=None):
-        self.cls = cls or query._primary_entity.type
+        self.cls = cls or query.column_descriptions[0]['entity']
         self.initial_query = query
         self.exclude_properties = []
+        self.fields = None
+        self.keyset = None
+        self.after = None
+        self.before = None
+        self.count = False
         self.page = current_app.config['PAGINATION_PAGE']
         self.per_page = current_app.config['PAGINATION_PER_PAGE']
         self.pagination = (self.page, self.per_page)
+        self.default_per_page = current_app.config.get(
+            'PAGINATION_DEFAULT_PER_PAGE', 50)
+        self.max_per_page = current_app.config.get(
+            'PAGINATION_MAX_PER_PAGE', 1000)
 
     def transform(self, query_args):
         """Return :class:`flask_sqlalchemy.Pagination` object from kwargs.
@@ -87,7 +105,7 @@ class QueryTransformer:
         :param query_args: A dictionary of values SQLA Alchemy will use to
             construct the query, where the key is the function/field name
             and the value is the value to pass to the function/field.
-            It can contain 4 different types of items:
+            It can contain 6 different types of items:
 
                 1. Keys accepted by :meth:`db.session.query.filter_by`.
 
@@ -120,24 +138,113 @@ class QueryTransformer:
                     `kwargs = {'page': 2, 'per_page': 25}`
                     `self.cls.query.paginate(2, 25, False)`
 
+                (On streamed routes `per_page` can be `all` to return
+                every row, see :meth:`.all_rows`.)
+
+                5. `$after` or `$before` cursors, which switch to keyset
+                pagination, see :meth:`.keyset_paginate`.
+
+                6. `$fields`, a comma separated list of the fields to
+                return.  Excluded and unselected columns are not loaded.
+
+                    `kwargs = {'$fields': 'id,first'}`
+
         If a kwarg not passed to `filter_by` is invalid the exception is
         caught & the query continues executing.  If a kwarg not designated
         special, is not a pagination kwarg, & is an invalid field will raise
         a subclassed :class:`core.api.exceptions.ApiError`.
         """
+        self.pop_fields_kwargs(query_args)
         self.pop_exclude_kwargs(query_args)
+        self.pop_keyset_kwargs(query_args)
         paginate = self.pop_pagination_kwargs(query_args)
         query = self.create_query(query_args)
         return self.paginate_query(query, paginate)
 
     def create_query(self, kwargs):
-        """Create the query.  Called by :meth:`.QueryTransformer.transform`."""
-        impl_data = self.prep_for_impl(kwargs)
+        """Create the query.  Called by :meth:`.QueryTransformer.transform`.
+
+        Only the values of `kwargs` are bound per request; everything that
+        depends on their keys comes from the cached :meth:`query_plan`.
+        """
         query = self.initial_query if self.initial_query else self.cls.query
-        for value_tuple in impl_data:
-            query = self.implement(query, value_tuple)
+        for key, column, func, query_column, method in self.query_plan(kwargs):
+            value = kwargs[key]
+            if method is None:
+                query = query_column.__class__(self.cls, query).handle(
+                    column, value, func)
+            else:
+                query = method(
+                    self.cls, query, column, query_column.convert(value))
+        return self.project_query(query)
+
+    def query_plan(self, kwargs):
+        """Return the plan for the keys of `kwargs` from the plan cache.
+
+        Plans are cached per transformer class, so subclasses with their own
+        `query_columns` get their own plans.  Instances that set
+        `query_columns` themselves are compiled on every call.
+        """
+        decorator = current_app.config.get("QUERY_METHOD_DECORATOR")
+        keys = tuple(sorted(kwargs))
+        if 'query_columns' in vars(self):
+            return self.compile_plan(keys, decorator)
+        key = (type(self), self.cls, keys, decorator)
+        cache = query_plan_cache()
+        plan = cache.get(key)
+        if plan is None:
+            plan = self.compile_plan(keys, decorator)
+            cache.set(key, plan)
+        return plan
+
+    def compile_plan(self, keys, decorator=None):
+        """Return a list of `(key, column, func, query_column, method)`.
+
+        Columns are resolved, validated and given their decorated query
+        method once.  `method` is None for query columns that override
+        `handle`, which is then called on every request.
+        """
+        plan = []
+        for column, key, func in self.prep_for_impl({k: k for k in keys}):
+            query_column = self.resolve_query_column(column)(self.cls, None)
+            method = None
+            if query_column.plannable:
+                query_column.check_exposed_column(column, func)
+                query_column.check_excludable_properties(column, func)
+                method = query_column.resolve_method(func)
+                if decorator:
+                    method = decorator(method)
+            plan.append((key, column, func, query_column, method))
+        return plan
+
+    def project_query(self, query):
+        """Defer loading the columns left out of the api response."""
+        columns = self.deferred_columns()
+        if columns:
+            query = query.options(
+                *[defer(getattr(self.cls, column)) for column in columns])
         return query
 
+    def deferred_columns(self):
+        """Return the excluded columns that are safe not to load.
+
+        Models with a hand written `api_response` may still read columns
+        that are not excludable, which would lazy load them row by row, so
+        only their `excludable_properties` are deferred.
+        """
+        mapper = inspect(self.cls)
+        compiled = getattr(self.cls, 'api_response', None) is \
+            SerializerMixin.api_response
+        excludable = getattr(self.cls, 'excludable_properties', [])
+        columns = []
+        for name in self.exclude_properties:
+            attr = mapper.column_attrs.get(name)
+            if attr is None or any(c.primary_key for c in attr.columns):
+                continue
+            if compiled or name in excludable:
+                columns.append(name)
+        return columns
+
     def prep_for_impl(self, kwargs):
         """Return list of tuples for each column.
 
@@ -164,6 +271,11 @@ class QueryTransformer:
     def implement(self, query, value_tuple):
         """Transform the query with column types corresponding query column."""
         column, value, func = value_tuple
+        impl_cls = self.resolve_query_column(column)
+        return impl_cls(self.cls, query).handle(column, value, func)
+
+    def resolve_query_column(self, column):
+        """Return the :class:`.BaseQueryColumn` subclass for `column`."""
         type_cls = None
         if column and hasattr(self.cls, column):
             try:
@@ -173,45 +285,154 @@ class QueryTransformer:
                 type_cls = "PropertyQueryColumn"
             except exc.InvalidRequestError:
                 pass
-        impl_cls = self.query_columns.get(type_cls, BaseQueryColumn)
-        return impl_cls(self.cls, query).handle(column, value, func)
+        return self.query_columns.get(type_cls, BaseQueryColumn)
 
     def pop_exclude_kwargs(self, kwargs):
         for key in kwargs:
             if key.endswith('__exclude'):
                 self.exclude_properties.append(key.split('__')[0][1:])
+        if self.fields is not None:
+            self.exclude_properties += [
+                field for field in api_fields(self.cls)
+                if field not in self.fields
+                and field not in self.exclude_properties]
         session.exclude_properties = list(self.exclude_properties)
         return True
 
+    def pop_fields_kwargs(self, kwargs):
+        """Set `self.fields` from the popped `$fields` kwarg.
+
+        Raises :class:`powernap.exceptions.InvalidFormError` for fields the
+        api response does not return.
+        """
+        value = kwargs.pop('$fields', None)
+        if value is None:
+            return False
+        self.fields = [f.strip() for f in value.split(',') if f.strip()]
+        allowed = api_fields(self.cls)
+        invalid = [f for f in self.fields if f not in allowed]
+        if invalid:
+            errors = {'fields': {
+                f: ["Invalid Argument: Field not exposed"] for f in invalid}}
+            raise InvalidFormError(description=errors)
+        return True
+
+    def pop_keyset_kwargs(self, kwargs):
+        """Set `self.keyset` if `$after` or `$before` is passed.
+
+        Also pops `$order_by`, which the keyset sorts by itself, and
+        `$count`, which adds the total to the page when true.
+        """
+        if '$after' not in kwargs and '$before' not in kwargs:
+            return False
+        self.after = kwargs.pop('$after', None)
+        self.before = kwargs.pop('$before', None)
+        self.count = kwargs.pop('$count', '').lower() in ('1', 'true')
+        self.keyset = Keyset(self.cls, kwargs.pop('$order_by', None))
+        return True
+
     def pop_pagination_kwargs(self, kwargs):
         """Return popped kwargs of first items in `self.pagination` tuples.
 
-        If :meth:`db.session.query.paginate` is passed just a `page`
-        argument and `page > 1` the method will fail.  If a `per_page`
-        argument is passed without a `page` the logical page number
-        should be `1`.  Therefore if one of the kwargs is missing the
-        `page` kwarg will default to `1`.
+        A missing `page` defaults to `1` and a missing `per_page` to
+        `PAGINATION_DEFAULT_PER_PAGE` in :meth:`.paginate_query`.
         """
         paginate = {}
         for key in self.pagination:
-            key = '$' + key
-            if key in kwargs:
-                try:
-                    paginate[key[1:]] = int(kwargs.pop(key))
-                except TypeError:
-                    pass
-        if len(paginate) != len(self.pagination):
-            paginate[self.page] = 1
+            value = kwargs.pop('$' + key, None)
+            if value is None:
+                continue
+            if key == self.per_page and value == ALL_ROWS:
+                paginate[key] = ALL_ROWS
+                continue
+            try:
+                paginate[key] = int(value)
+            except (TypeError, ValueError):
+                msg = "Invalid Value: {} must be an integer".format(key)
+                errors = {'query_construction': [msg]}
+                raise InvalidFormError(description=errors)
         return paginate
 
     def paginate_query(self, query, paginate):
-        """Return :class:`flask_sqlalchemy.Pagination` object from query."""
+        """Return :class:`flask_sqlalchemy.Pagination` object from query.
 
+        `per_page` is capped at `PAGINATION_MAX_PER_PAGE`.  The total is
+        counted with the route's `count` strategy, or `PAGINATION_COUNT`.
+        """
+        per_page = paginate.get(self.per_page, self.default_per_page)
+        if per_page == ALL_ROWS:
+            return self.all_rows(query)
+        per_page = max(1, min(per_page, self.max_per_page))
+        if self.keyset:
+            return self.keyset_paginate(query, per_page)
+        strategy = get_count_strategy(g.get('count_strategy') or
+                                      current_app.config.get(
+                                          'PAGINATION_COUNT', 'exact'))
         try:
-            return query.paginate(paginate.get(self.page, 1),
-                                  paginate.get(self.per_page, query.count()),
-                                  False)
+            return strategy.paginate(
+                query, paginate.get(self.page, 1), per_page)
         except exc.OperationalError as e:
             msg = "Invalid Value: {}".format(e.orig.args[-1])
             errors = {'query_construction': [msg]}
             raise InvalidFormError(description=errors)
+
+    def keyset_paginate(self, query, per_page):
+        """Return :class:`.keyset.KeysetPagination` object from query.
+
+        Returns the page after the `$after` cursor, or before the `$before`
+        cursor.  An empty `$after` is the first page and an empty `$before`
+        the last.  Any sort of the query is replaced by the keyset's.
+        """
+        total = query.order_by(None).count() if self.count else None
+        reverse = self.after is None
+        cursor = self.before if reverse else self.after
+        query = self.keyset.order(query, reverse)
+        if cursor:
+            query = self.keyset.filter(query, cursor, reverse)
+        items = query.limit(per_page + 1).all()
+        more = len(items) > per_page
+        items = items[:per_page]
+        if reverse:
+            items.reverse()
+        has_next, has_prev = (bool(cursor), more) if reverse else \
+            (more, bool(cursor))
+        return KeysetPagination(
+            items, per_page,
+            next_cursor=self.keyset.cursor(items[-1])
+            if has_next and items else None,
+            prev_cursor=self.keyset.cursor(items[0])
+            if has_prev and items else None,
+            total=total, query=query)
+
+    def all_rows(self, query):
+        """Return `query` to be streamed, fetching rows in batches.
+
+        Only routes with the `stream` decorator accept `$per_page=all`;
+        their response iterates the query with `yield_per`, so rows are
+        read through a server side cursor where the driver supports it
+        and never held in memory all at once.
+        """
+        if not g.get('stream_response'):
+            msg = "Invalid Value: {} cannot be '{}' on this endpoint".format(
+                self.per_page, ALL_ROWS)
+            raise InvalidFormError(description={'query_construction': [msg]})
+        return query.yield_per(
+            current_app.config.get('PAGINATION_YIELD_PER', 1000))
+
+
+_plans = None
+_plans_pid = None
+
+
+def query_plan_cache():
+    """Return the cache of :meth:`QueryTransformer.compile_plan` results.
+
+    Settings:
+        `QUERY_PLAN_CACHE_SIZE`: Max plans cached per worker.  Plans are
+            keyed by transformer class, model and query arg names.
+    """
+    global _plans, _plans_pid
+    if _plans is None or _plans_pid != os.getpid():
+        _plans = LRUCache(current_app.config.get('QUERY_PLAN_CACHE_SIZE', 512))
+        _plans_pid = os.getpid()
+    return _plans
@@ -0,0 +1,118 @@
+"""Sanitize response data with bleach."""
+
+import re
+import sys
+import threading
+from collections import OrderedDict
+
+import bleach
+from flask import current_app
+
+# Characters that make `bleach.clean` change a string.  Besides markup,
+# bleach normalizes `\r` and replaces or drops other control characters.
+_UNSAFE_CHARS = re.compile('[\x00-\x08\x0b-\x1f&<>]')
+
+
+class SanitizeCache(object):
+    """LRU memo of bleached strings, bounded by their size in bytes.
+
+    Only strings with markup or control characters reach bleach, see
+    :func:`clean`.  Listings often repeat those too (`R&D`, `<b>New</b>`),
+    so each distinct one only has to be parsed by bleach once per worker.
+    """
+    def __init__(self, max_bytes=1024 * 1024, max_item_bytes=16 * 1024,
+                 options=None):
+        """
+        :param max_bytes: (int): Max total size of cached strings. `0`
+            disables caching.
+        :param max_item_bytes: (int): Strings larger than this are bleached
+            but not cached.
+        :param options: (dict): Kwargs passed to :func:`bleach.clean`.
+        """
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self.options = options or {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def clean(self, value):
+        key = value
+        with self._lock:
+            cached = self._data.get(key)
+            if cached is not None:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return cached[0]
+            self.misses += 1
+        cleaned = bleach.clean(value, **self.options)
+        weight = sys.getsizeof(value) + sys.getsizeof(cleaned)
+        if weight <= min(self.max_item_bytes, self.max_bytes):
+            with self._lock:
+                if key not in self._data:
+                    self._data[key] = (cleaned, weight)
+                    self.size += weight
+                while self.size > self.max_bytes:
+                    _, (_, evicted) = self._data.popitem(last=False)
+                    self.size -= evicted
+        return cleaned
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    @property
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'items': len(self._data),
+            'bytes': self.size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+def sanitize_cache():
+    """Return the app's :class:`SanitizeCache`, created on first use.
+
+    The cache is kept in `app.extensions`, so each app bleaches with its
+    own options.
+
+    Settings:
+        `SANITIZE_CACHE_MAX_BYTES`: Size of the cache. `0` disables it.
+        `SANITIZE_CACHE_MAX_ITEM_BYTES`: Largest string that is cached.
+        `BLEACH_OPTIONS`: Kwargs passed to :func:`bleach.clean`.
+    """
+    cache = current_app.extensions.get('powernap.sanitize')
+    if cache is None:
+        config = current_app.config
+        cache = current_app.extensions['powernap.sanitize'] = SanitizeCache(
+            max_bytes=config.get('SANITIZE_CACHE_MAX_BYTES', 1024 * 1024),
+            max_item_bytes=config.get(
+                'SANITIZE_CACHE_MAX_ITEM_BYTES', 16 * 1024),
+            options=config.get('BLEACH_OPTIONS'),
+        )
+    return cache
+
+
+def clean(value):
+    """Return `value` bleached, skipping strings bleach would not change."""
+    if not _UNSAFE_CHARS.search(value):
+        return value
+    return sanitize_cache().clean(value)
+
+
+def sanitize(data):
+    """Recursively bleach all the strings of dicts, lists and tuples."""
+    if isinstance(data, dict):
+        data = {sanitize(k): sanitize(v) for k, v in data.items()}
+    elif isinstance(data, (list, tuple)):
+        data = [sanitize(i) for i in data]
+    elif isinstance(data, str):
+        data = clean(data)
+    return data
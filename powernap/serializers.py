@@ -0,0 +1,97 @@
+"""Compile `api_response` functions for :class:`powernap.mixins.SerializerMixin`.
+
+A serializer is generated once per model and set of excluded properties
+as a single function returning a dict literal, so rows are serialized
+without per field loops, lookups or checks.
+"""
+import keyword
+import os
+
+from flask import current_app
+from sqlalchemy import inspect
+from sqlalchemy.types import Date, DateTime, Numeric, Time, TypeDecorator
+
+from powernap.helpers import LRUCache
+
+
+def api_fields(cls):
+    """Return the names of the fields `cls` returns from `api_response`.
+
+    Uses `cls.api_fields` when set, otherwise `cls.exposed_fields`
+    followed by `cls.excludable_properties`.
+    """
+    if getattr(cls, 'api_fields', None) is not None:
+        return list(cls.api_fields)
+    fields = list(getattr(cls, 'exposed_fields', []))
+    fields += [p for p in getattr(cls, 'excludable_properties', [])
+               if p not in fields]
+    return fields
+
+
+def compile_serializer(cls, exclude_properties=()):
+    """Return a `func(instance)` building the api response dict of `cls`."""
+    mapper = inspect(cls)
+    namespace = {}
+    items = []
+    for i, field in enumerate(api_fields(cls)):
+        if field in exclude_properties:
+            continue
+        if field.isidentifier() and not keyword.iskeyword(field):
+            getter = "obj.{}".format(field)
+        else:
+            getter = "getattr(obj, {!r})".format(field)
+        converter = column_converter(mapper, field)
+        if converter:
+            name = "_convert_{}".format(i)
+            namespace[name] = converter
+            getter = "{}({})".format(name, getter)
+        items.append("{!r}: {}".format(field, getter))
+    source = "def serialize(obj):\n    return {{{}}}\n".format(", ".join(items))
+    exec(compile(source, "<{} serializer>".format(cls.__name__), "exec"),
+         namespace)
+    return namespace["serialize"]
+
+
+def column_converter(mapper, field):
+    """Return a function converting the column's values to JSON types.
+
+    Values the encoder would convert anyway (decimals, dates) are
+    converted here so they skip the encoder's `default` hook.
+    """
+    column = mapper.columns.get(field)
+    if column is None or isinstance(column.type, TypeDecorator):
+        return None
+    if isinstance(column.type, Numeric) and column.type.asdecimal:
+        return _to_float
+    if isinstance(column.type, (DateTime, Date, Time)):
+        return _isoformat
+    return None
+
+
+def _to_float(value):
+    return None if value is None else float(value)
+
+
+def _isoformat(value):
+    return None if value is None else value.isoformat()
+
+
+_serializers = None
+_serializers_pid = None
+
+
+def serializer_cache():
+    """Return the process's cache of compiled serializers.
+
+    Clients choose the excluded properties, so serializers are kept in an
+    LRU instead of one per combination ever requested.
+
+    Setting: `API_SERIALIZER_CACHE_SIZE`, max serializers per worker.
+        Defaults to `1024`.
+    """
+    global _serializers, _serializers_pid
+    if _serializers is None or _serializers_pid != os.getpid():
+        _serializers = LRUCache(
+            current_app.config.get('API_SERIALIZER_CACHE_SIZE', 1024))
+        _serializers_pid = os.getpid()
+    return _serializers
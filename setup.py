@@ -28,6 +28,9 @@ if __name__ == '__main__':
             'graphene==2.1.2',
             'graphene-sqlalchemy==2.0.0',
         ],
+        extras_require={
+            'orjson': ['orjson>=3.0.0'],
+        },
         classifiers=[
             'Programming Language :: Python',
             'Intended Audience :: Developers',